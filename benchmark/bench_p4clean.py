@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Pascal Lalancette
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Benchmark p4clean on synthetic workspaces.
+
+For every size, a workspace is generated in a temporary folder and p4clean
+is timed phase by phase against `fake_p4.py`, a stand-in for the `p4`
+command line answering from the generated workspace manifest:
+
+    python benchmark/bench_p4clean.py --files 10000,100000,1000000
+
+Each backend cleans its own copy of the workspace: the tracked files listed
+by fstat (the default) and the files to add computed by `p4 reconcile -n -a`
+(--reconcile, under 'fstat'). The fake server walks the workspace for
+reconcile in Python: compare against a real server before concluding.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import logging
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_PATH))
+
+import p4clean
+from fake_p4 import MANIFEST_VARIABLE
+
+PHASES = ('info', 'fstat', 'walk', 'diff', 'delete', 'total')
+
+BACKENDS = ('fstat', 'reconcile')
+
+
+class Workspace(object):
+
+    """ Synthetic Perforce workspace."""
+
+    def __init__(self, root, files, depth, fanout, untracked, symlinks, seed=0):
+        self.root = root
+        self.files = files
+        self.depth = depth
+        self.fanout = fanout
+        self.untracked = untracked
+        self.symlinks = symlinks
+        self.random = random.Random(seed)
+        self.manifest = os.path.join(root, 'manifest')
+        self.client_root = os.path.join(root, 'workspace')
+        self.bin = os.path.join(root, 'bin')
+        self.tracked_count = 0
+        self.untracked_count = 0
+        self.symlinks_count = 0
+
+    def generate(self):
+        """ Create the folder tree, the files, the manifest and the fake
+        `p4` executable."""
+        folders = self._create_folders()
+        manifest_file = open(self.manifest, 'w')
+        try:
+            manifest_file.write("%s\n%s\n%d\n" % (self.client_root, 'bench', 1000))
+            for index in xrange(self.files):
+                folder = folders[index % len(folders)]
+                filename = os.path.join(folder, 'file%d.txt' % index)
+                open(filename, 'w').close()
+                if self.random.random() < self.untracked:
+                    self.untracked_count += 1
+                    continue
+                self.tracked_count += 1
+                kind = 'h'
+                if self.random.random() < 0.001:
+                    kind = 'o'
+                manifest_file.write("%s %s\n" % (kind, os.path.relpath(filename, self.client_root)))
+        finally:
+            manifest_file.close()
+        self._create_symlinks(folders)
+        self._create_p4_executable()
+
+    def _create_folders(self):
+        """ Return the folders of a tree `depth` levels deep with `fanout`
+        sub folders per folder."""
+        folders = [self.client_root]
+        level = [self.client_root]
+        os.makedirs(self.client_root)
+        for depth in range(self.depth):
+            next_level = []
+            for parent in level:
+                for index in range(self.fanout):
+                    folder = os.path.join(parent, 'dir%d' % index)
+                    os.mkdir(folder)
+                    next_level.append(folder)
+            folders.extend(next_level)
+            level = next_level
+        return folders
+
+    def _create_symlinks(self, folders):
+        """ Create untracked symbolic links to folders of the tree."""
+        if not hasattr(os, 'symlink'):
+            return
+        count = int(self.files * self.symlinks)
+        for index in xrange(count):
+            folder = self.random.choice(folders)
+            target = self.random.choice(folders)
+            os.symlink(target, os.path.join(folder, 'link%d' % index))
+            self.symlinks_count += 1
+
+    def _create_p4_executable(self):
+        os.mkdir(self.bin)
+        fake_p4 = os.path.join(BENCHMARK_PATH, 'fake_p4.py')
+        if sys.platform == 'win32':
+            p4 = os.path.join(self.bin, 'p4.bat')
+            script = '@"%s" "%s" %%*\r\n' % (sys.executable, fake_p4)
+        else:
+            p4 = os.path.join(self.bin, 'p4')
+            script = '#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, fake_p4)
+        p4_file = open(p4, 'w')
+        try:
+            p4_file.write(script)
+        finally:
+            p4_file.close()
+        os.chmod(p4, 0755)
+
+    def activate(self):
+        """ Make the fake `p4` answer from this workspace."""
+        os.environ['PATH'] = self.bin + os.pathsep + os.environ['PATH']
+        os.environ[MANIFEST_VARIABLE] = self.manifest
+        os.chdir(self.client_root)
+
+
+class Timer(object):
+
+    """ Time the phases of a clean."""
+
+    def __init__(self):
+        self.times = {}
+
+    def time(self, phase, function, *args):
+        start = time.time()
+        result = function(*args)
+        self.times[phase] = self.times.get(phase, 0.0) + time.time() - start
+        return result
+
+
+def benchmark(workspace, jobs, processes=1, backend='fstat'):
+    """ Clean `workspace` like `P4Clean.run` does and check that exactly
+    the untracked files were deleted. Return the duration of each phase.
+    With worker `processes`, the fstat, walk, diff and delete phases are
+    timed as a whole, under 'delete'. The 'reconcile' `backend` asks
+    Perforce for the files to add instead of the tracked files."""
+    timer = Timer()
+    start = time.time()
+    p4clean_instance = timer.time('info', p4clean.P4Clean)
+    p4clean_instance.jobs = jobs
+    p4clean_instance.processes = processes
+    perforce = p4clean_instance.perforce
+    perforce.use_reconcile = backend == 'reconcile'
+    if not perforce.is_inside_workspace():
+        raise RuntimeError("The workspace is not the fake p4 client")
+    p4clean_instance.config = p4clean.P4CleanConfig(perforce.root)
+    root = os.getcwd()
+    if processes > 1:
+        result = timer.time('delete', p4clean_instance.clean, root)
+    else:
+        # Phases are timed one after the other: `P4Clean.clean` overlaps the
+        # walk with the Perforce query.
+        tracked_files = timer.time('fstat', perforce.get_tracked_files, root)
+        listings = timer.time('walk', p4clean_instance._get_listings, root)
+        timer.time('diff', p4clean_instance._find_untracked, root, listings, tracked_files)
+        result = timer.time('delete', p4clean_instance._clean_listings, root, listings, tracked_files)
+        # The clean plans the deletions again before deleting.
+        timer.times['delete'] -= timer.times['diff']
+    timer.times['total'] = time.time() - start
+    (deleted_files_count, file_error_msgs,
+     deleted_folders_count, folder_error_msgs) = result
+    if file_error_msgs or folder_error_msgs:
+        raise RuntimeError("\n".join(file_error_msgs + folder_error_msgs))
+    expected_count = workspace.untracked_count + workspace.symlinks_count
+    if deleted_files_count != expected_count:
+        raise RuntimeError("%d files deleted instead of %d" % (deleted_files_count, expected_count))
+    return timer.times
+
+
+def parse_sizes(sizes):
+    return [int(size.lower().replace('k', '000').replace('m', '000000'))
+            for size in sizes.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', default='10k,100k',
+                        help="comma separated workspace sizes in files (e.g.: 10k,100k,1m,5m) (default: %(default)s)")
+    parser.add_argument('--depth', type=int, default=4,
+                        help="folder tree depth (default: %(default)s)")
+    parser.add_argument('--fanout', type=int, default=6,
+                        help="sub folders per folder (default: %(default)s)")
+    parser.add_argument('--untracked', type=float, default=0.1,
+                        help="ratio of untracked files (default: %(default)s)")
+    parser.add_argument('--symlinks', type=float, default=0.001,
+                        help="untracked symbolic links per file (default: %(default)s)")
+    parser.add_argument('-j', '--jobs', type=int, default=p4clean.DEFAULT_JOBS,
+                        help="p4clean jobs (default: %(default)s)")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="p4clean worker processes (default: %(default)s)")
+    parser.add_argument('--backends', default=",".join(BACKENDS),
+                        help="comma separated backends to compare (default: %(default)s)")
+    parser.add_argument('--keep', action='store_true',
+                        help="do not delete the generated workspaces")
+    args = parser.parse_args()
+
+    p4clean.logger.setLevel(logging.ERROR)
+    environment = dict(os.environ)
+    cwd = os.getcwd()
+    backends = args.backends.split(',')
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error("unknown backend: %s" % backend)
+    print "%10s %10s %10s %10s " % ('files', 'untracked', 'backend', 'generate') + \
+        " ".join("%8s" % phase for phase in PHASES)
+    for size, backend in [(size, backend) for size in parse_sizes(args.files)
+                          for backend in backends]:
+        root = tempfile.mkdtemp(prefix='p4clean_bench_')
+        try:
+            # Same seed: every backend cleans the same workspace.
+            workspace = Workspace(root, size, args.depth, args.fanout,
+                                  args.untracked, args.symlinks)
+            start = time.time()
+            workspace.generate()
+            generate_time = time.time() - start
+            workspace.activate()
+            times = benchmark(workspace, args.jobs, args.processes, backend)
+            print "%10d %10d %10s %10.2f " % (size, workspace.untracked_count + workspace.symlinks_count,
+                                              backend, generate_time) + \
+                " ".join(phase in times and "%8.2f" % times[phase] or "%8s" % '-' for phase in PHASES)
+            sys.stdout.flush()
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environment)
+            if args.keep:
+                print "Workspace kept in %s" % root
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2013 Pascal Lalancette
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Stand-in for the Perforce `p4` command line, for benchmarks.
+
+Answers the commands p4clean runs from a manifest file named by the
+`P4CLEAN_FAKE_MANIFEST` environment variable. The manifest is written by
+`bench_p4clean.py`:
+
+    <client root>
+    <client name>
+    <highest synced changelist>
+    h <synced file path, relative to the client root>
+    o <opened file path, relative to the client root>
+    ...
+"""
+
+import os
+import sys
+import marshal
+
+MANIFEST_VARIABLE = 'P4CLEAN_FAKE_MANIFEST'
+
+
+class Manifest(object):
+
+    """ Workspace described by a manifest file."""
+
+    def __init__(self, path):
+        manifest_file = open(path)
+        try:
+            self.root = manifest_file.readline().rstrip('\n')
+            self.client = manifest_file.readline().rstrip('\n')
+            self.change = int(manifest_file.readline())
+            self.have = []
+            self.opened = []
+            # Absolute paths of the files by folder, by files list id.
+            self.folders = {}
+            for line in manifest_file:
+                kind, filename = line[0], line[2:].rstrip('\n')
+                if kind == 'h':
+                    self.have.append(filename)
+                elif kind == 'o':
+                    self.opened.append(filename)
+        finally:
+            manifest_file.close()
+
+    def files(self, path, files):
+        """ Yield the absolute path of `files` matching the 'path' argument
+        (e.g.: /root/folder/..., /root/folder/* or /root/folder/...#have)."""
+        path = path.split('#')[0].split('@')[0]
+        if path.endswith('*'):
+            # Files directly in the folder.
+            folder = os.path.normpath(path[:-1])
+            for filename in self._folders(files).get(folder, ()):
+                yield filename
+            return
+        if path.endswith('...'):
+            prefix = os.path.normpath(path[:-3])
+        else:
+            prefix = os.path.normpath(path)
+        for filename in files:
+            filename = os.path.join(self.root, filename)
+            if filename.startswith(prefix):
+                yield filename
+
+    def _folders(self, files):
+        folders = self.folders.get(id(files))
+        if folders is None:
+            folders = self.folders[id(files)] = {}
+            for filename in files:
+                filename = os.path.join(self.root, filename)
+                folders.setdefault(os.path.dirname(filename), []).append(filename)
+        return folders
+
+
+def info(manifest, arguments):
+    marshal.dump({'code': 'stat',
+                  'userName': 'bench',
+                  'clientName': manifest.client,
+                  'clientRoot': manifest.root,
+                  'serverVersion': 'P4D/LINUX26X86_64/2013.1/610569 (2013/03/19)'},
+                 sys.stdout, 0)
+
+
+def where(manifest, arguments):
+    path = os.path.join(os.getcwd(), '...')
+    marshal.dump({'code': 'stat',
+                  'depotFile': '//depot/...',
+                  'clientFile': '//%s/...' % manifest.client,
+                  'path': path},
+                 sys.stdout, 0)
+
+
+def fstat(manifest, arguments):
+    """ -Rh streams synced files, -Ro opened files and no filter both."""
+    records = []
+    if '-Ro' not in arguments:
+        records.append((manifest.have, {'haveRev': '1'}))
+    if '-Rh' not in arguments:
+        records.append((manifest.opened, {'action': 'add'}))
+    maximum = None
+    if '-m' in arguments:
+        maximum = int(arguments[arguments.index('-m') + 1])
+    # File arguments follow the options and their values.
+    paths = []
+    for index, argument in enumerate(arguments):
+        if not argument.startswith('-') and arguments[index - 1] not in ('-m', '-T'):
+            paths.append(argument)
+    answered = 0
+    for path in paths:
+        path_answered = answered
+        for files, fields in records:
+            for filename in manifest.files(path, files):
+                if answered == maximum:
+                    return
+                answered = answered + 1
+                record = {'code': 'stat', 'clientFile': filename}
+                record.update(fields)
+                marshal.dump(record, sys.stdout, 0)
+        if answered == path_answered:
+            _warning("%s - no such file(s)." % path)
+
+
+def reconcile(manifest, arguments):
+    """ -n -a: the local files neither synced nor opened, to add. Symbolic
+    links to folders are files."""
+    path = arguments[-1]
+    if path.endswith('...'):
+        path = path[:-3]
+    known = set(os.path.join(manifest.root, filename)
+                for filename in manifest.have + manifest.opened)
+    answered = False
+    for folder, directories, files in os.walk(os.path.normpath(path)):
+        files = files + [directory for directory in directories
+                         if os.path.islink(os.path.join(folder, directory))]
+        for name in files:
+            filename = os.path.join(folder, name)
+            if filename in known:
+                continue
+            answered = True
+            marshal.dump({'code': 'stat', 'clientFile': filename,
+                          'depotFile': '//depot/' + os.path.relpath(filename, manifest.root),
+                          'workRev': '1', 'action': 'add'}, sys.stdout, 0)
+    if not answered:
+        _warning("%s - no file(s) to reconcile." % arguments[-1])
+
+
+def changes(manifest, arguments):
+    marshal.dump({'code': 'stat', 'change': str(manifest.change)}, sys.stdout, 0)
+
+
+def sizes(manifest, arguments):
+    files = list(manifest.files(arguments[-1], manifest.have))
+    size = sum([os.path.getsize(filename) for filename in files if os.path.exists(filename)])
+    marshal.dump({'code': 'stat', 'fileCount': str(len(files)), 'fileSize': str(size)},
+                 sys.stdout, 0)
+
+
+def _warning(message):
+    marshal.dump({'code': 'error', 'severity': 2, 'generic': 17,
+                  'data': message + '\n'}, sys.stdout, 0)
+
+
+COMMANDS = {
+    'info': info,
+    'where': where,
+    'fstat': fstat,
+    'reconcile': reconcile,
+    'changes': changes,
+    'sizes': sizes,
+}
+
+
+def main(arguments):
+    # Global options (only -G is supported: output is always marshalled)
+    while arguments and arguments[0].startswith('-'):
+        arguments = arguments[1:]
+    if not arguments or arguments[0] not in COMMANDS:
+        sys.stderr.write("fake p4: unsupported command: %s\n" % " ".join(arguments))
+        return 1
+    manifest = Manifest(os.environ[MANIFEST_VARIABLE])
+    COMMANDS[arguments[0]](manifest, arguments[1:])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -33,10 +33,74 @@ import re
 import fnmatch
 import ConfigParser
 import logging
+import marshal
 import platform
+import zlib
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import time
+import Queue
+import contextlib
+import copy
+import json
+import bisect
+import errno
+import select
+import socket
+import struct
+import hashlib
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+# Linux C library functions: deletion relative to a folder descriptor
+# (unlinkat), so the folder path is resolved once for all its entries, and
+# folder watches (inotify).
+_unlinkat = None
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _unlinkat = _libc.unlinkat
+        _unlinkat.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int)
+        _unlinkat.restype = ctypes.c_int
+    except (ImportError, OSError, AttributeError):
+        _libc = None
+        _unlinkat = None
+AT_REMOVEDIR = 0x200
+# Linux socket option giving the credentials of the process at the other end
+# of a unix socket (not in the socket module of Python 2).
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+try:
+    # Faster folder listing (https://pypi.python.org/pypi/scandir)
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 __version__ = '0.3.2'
 
+# Number of threads listing folders or deleting files in parallel.
+DEFAULT_JOBS = 8
+
+# Have list cache file name. The cache is saved at the client root.
+CACHE_FILENAME = '.p4clean.cache'
+# Folder tree snapshot file name. The snapshot is saved in the cleaned folder.
+SNAPSHOT_FILENAME = '.p4clean.snapshot'
+# Seconds between two checks for a sync or opened files by the watch service.
+DEFAULT_WATCH_INTERVAL = 30
+# Seconds without output before a Perforce command is stopped.
+DEFAULT_P4_TIMEOUT = 300
+# Times a Perforce command failing on a timeout or a lost connection is run
+# again.
+DEFAULT_P4_RETRIES = 2
+
 # Use
 logging.basicConfig(format='%(message)s')
 logger = logging.getLogger('p4clean')
@@ -46,138 +110,1386 @@ class ShellExecuteException(Exception):
     pass
 
 
-def shell_execute(command):
-    """ Run a shell command
+class TransientShellException(ShellExecuteException):
+    """ The command failed but may succeed if run again (e.g.: timeout, lost
+    connection)."""
+    pass
+
+
+class Stats(object):
+
+    """ Wall and CPU time of the clean phases and counters of the system
+    calls issued. Phases run in parallel threads overlap: their CPU time is
+    the whole process CPU time while they ran."""
+
+    # System calls counters.
+    SYSCALLS = ('listdir', 'lstat', 'open', 'close', 'unlink', 'chmod', 'rmdir', 'p4 commands')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.start_cpu_time = self._cpu_time()
+        # Phases [wall time, cpu time] by name, in start order.
+        self.phases = {}
+        self.phase_names = []
+        self.counters = {}
+
+    @staticmethod
+    def _cpu_time():
+        times = os.times()
+        return times[0] + times[1]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the phase `name`. Times add up if the phase runs again."""
+        start_time = time.time()
+        start_cpu_time = self._cpu_time()
+        try:
+            yield
+        finally:
+            wall_time = time.time() - start_time
+            cpu_time = self._cpu_time() - start_cpu_time
+            with self.lock:
+                if name not in self.phases:
+                    self.phases[name] = [0.0, 0.0]
+                    self.phase_names.append(name)
+                self.phases[name][0] += wall_time
+                self.phases[name][1] += cpu_time
+
+    def count(self, name, value=1):
+        """ Add `value` to the counter `name`."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, values):
+        """ Add the phases and counters of `as_dict()` `values` (e.g.: from
+        a worker process)."""
+        with self.lock:
+            for phase in values['phases']:
+                name = phase['name']
+                if name not in self.phases:
+                    self.phases[name] = [0.0, 0.0]
+                    self.phase_names.append(name)
+                self.phases[name][0] += phase['wall_time']
+                self.phases[name][1] += phase['cpu_time']
+            for name, value in values['counters'].iteritems():
+                if name != 'syscalls':
+                    self.counters[name] = self.counters.get(name, 0) + value
+
+    def peak_rss(self):
+        """ Return the peak resident memory in bytes. Return None if it is
+        not known."""
+        if resource is None:
+            return None
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            # Kilobytes everywhere but on OS X.
+            peak_rss = peak_rss * 1024
+        return peak_rss
+
+    def as_dict(self):
+        """ Return the phases, the counters, the total time and the peak
+        resident memory."""
+        with self.lock:
+            phases = [{'name': name,
+                       'wall_time': self.phases[name][0],
+                       'cpu_time': self.phases[name][1]}
+                      for name in self.phase_names]
+            counters = dict(self.counters)
+        counters['syscalls'] = sum([counters.get(name, 0) for name in Stats.SYSCALLS])
+        return {'phases': phases,
+                'counters': counters,
+                'wall_time': time.time() - self.start_time,
+                'cpu_time': self._cpu_time() - self.start_cpu_time,
+                'peak_rss': self.peak_rss()}
+
+    def format(self):
+        """ Return the stats as a human readable table."""
+        values = self.as_dict()
+        lines = ["%-20s %10s %10s" % ('phase', 'wall (s)', 'cpu (s)')]
+        for phase in values['phases'] + [{'name': 'total',
+                                          'wall_time': values['wall_time'],
+                                          'cpu_time': values['cpu_time']}]:
+            lines.append("%-20s %10.3f %10.3f" % (phase['name'], phase['wall_time'], phase['cpu_time']))
+        lines.append("")
+        for name in sorted(values['counters']):
+            lines.append("%-20s %10d" % (name, values['counters'][name]))
+        if values['peak_rss'] is not None:
+            lines.append("%-20s %10.1f" % ('peak rss (MB)', values['peak_rss'] / (1024.0 * 1024.0)))
+        return "\n".join(lines)
+
+    def save(self, path):
+        """ Save the stats as JSON at 'path'. Return False if the file
+        cannot be written."""
+        try:
+            output_file = open(path, 'w')
+            try:
+                json.dump(self.as_dict(), output_file, indent=2, sort_keys=True)
+            finally:
+                output_file.close()
+        except (IOError, OSError):
+            return False
+        return True
+
+
+# Stats of the running clean.
+stats = Stats()
+
+
+def shell_marshal(command, timeout=None):
+    """ Run a shell command printing Python marshalled objects (e.g.: `p4 -G`)
+    and stream its output
+
+    :command: the shell command to run (string or arguments list)
+    :timeout: seconds without output before the command is stopped (never by
+    default)
+    :returns: a generator over the unmarshalled objects. Raise
+    `ShellExecuteException` if the command fail and
+    `TransientShellException` if it timed out.
+
+    """
+    return _shell_output(command, _unmarshal, None, timeout)
+
 
-    :command: the shell command to run
-    :returns: None if command fail else the command output
+def _unmarshal(stream):
+    """ Yield marshalled objects read from 'stream' until its end.
 
+    The stream is read by chunks: unlike `marshal.load`, other threads run
+    while the command is waited for. Perforce writes version 0 marshal data:
+    an object takes the size it dumps to in version 0.
     """
+    fd = stream.fileno()
+    data = ''
+    offset = 0
+    while True:
+        chunk = os.read(fd, 65536)
+        stats.count('p4 bytes read', len(chunk))
+        data = data[offset:] + chunk
+        offset = 0
+        while offset < len(data):
+            try:
+                item = marshal.loads(buffer(data, offset))
+            except (EOFError, ValueError):
+                # Partly read
+                break
+            offset = offset + len(marshal.dumps(item, 0))
+            yield item
+        if not chunk:
+            if offset < len(data):
+                # Truncated
+                raise ShellExecuteException
+            return
+
+
+def _shell_output(command, read, stderr, timeout=None):
+    """ Run a shell command and yield what `read` gets from its output. The
+    command is killed if it outputs nothing for `timeout` seconds."""
+    if isinstance(command, basestring):
+        command = command.split()
+    stats.count('p4 commands')
     try:
-        result = subprocess.check_output(command.split(),
-                                         stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError, e:
-        logger.error("Error while calling command `%s`:%s " % (command, e))
+        process = subprocess.Popen(command,
+                                   stdout=subprocess.PIPE,
+                                   stderr=stderr)
+    except OSError, e:
+        logger.error("Error while calling command `%s`:%s " % (" ".join(command), e))
+        raise ShellExecuteException
+    watchdog = None
+    if timeout:
+        watchdog = _Watchdog(process, timeout)
+    read_error = False
+    try:
+        for item in read(process.stdout):
+            yield item
+            if watchdog:
+                # Time spent by the caller is not the command's.
+                watchdog.touch()
+    except GeneratorExit:
+        # The caller stopped reading: the rest of the output is not wanted.
+        process.kill()
+        process.wait()
+        raise
+    except ShellExecuteException:
+        # Output cut short (e.g.: killed by the watchdog in the middle of a
+        # record).
+        read_error = True
+    finally:
+        if watchdog:
+            watchdog.stop()
+            # Not left running at interpreter shutdown.
+            watchdog.join()
+        process.stdout.close()
+    returncode = process.wait()
+    if watchdog and watchdog.expired:
+        logger.error("Command `%s` stopped: no output for %s seconds" % (" ".join(command), timeout))
+        raise TransientShellException
+    if read_error:
+        logger.error("Error while calling command `%s`: truncated output" % " ".join(command))
+        raise ShellExecuteException
+    if returncode:
+        logger.error("Error while calling command `%s`: returned non-zero exit status %d " % (" ".join(command), returncode))
         raise ShellExecuteException
-    return result
+
+
+class _Watchdog(threading.Thread):
+
+    """ Kill a process once `touch()` was not called for `timeout`
+    seconds."""
+
+    def __init__(self, process, timeout):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.process = process
+        self.timeout = timeout
+        self.last_activity = time.time()
+        self.expired = False
+        self.stopped = threading.Event()
+        self.start()
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while True:
+            remaining = self.last_activity + self.timeout - time.time()
+            if remaining <= 0:
+                break
+            self.stopped.wait(remaining)
+            if self.stopped.is_set():
+                return
+        self.expired = True
+        try:
+            self.process.kill()
+        except OSError:
+            # Exited meanwhile
+            pass
+
+
+def load_marshal_file(path):
+    """ Return the object saved by `save_marshal_file` at 'path'. Return None
+    if the file cannot be read."""
+    try:
+        input_file = open(path, 'rb')
+        try:
+            return marshal.loads(zlib.decompress(input_file.read()))
+        finally:
+            input_file.close()
+    except (IOError, EOFError, ValueError, TypeError, zlib.error):
+        return None
+
+
+def save_marshal_file(path, value):
+    """ Save a marshalled and compressed `value` at 'path'. Return False if
+    the file cannot be written."""
+    data = zlib.compress(marshal.dumps(value))
+    try:
+        # Write aside then rename so a partial file is never read.
+        output_file = open(path + '.tmp', 'wb')
+        try:
+            output_file.write(data)
+        finally:
+            output_file.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def remove_files(filenames, jobs=DEFAULT_JOBS):
+    """ Delete files with a pool of `jobs` threads. Return the error of
+    each file, in the `filenames` order. None if the file was deleted.
+
+    Where available, the files of a folder are deleted relative to a
+    descriptor of the folder, opened once without following a symbolic link.
+    """
+    if _unlinkat is None:
+        remove, tasks, chunk_size = _remove_file, filenames, 64
+    else:
+        remove, tasks, chunk_size = _remove_folder_files, _folder_batches(filenames), 4
+    with stats.phase('unlink'):
+        if jobs > 1 and len(tasks) > 1:
+            pool = ThreadPool(jobs)
+            try:
+                results = list(pool.imap(remove, tasks, chunk_size))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(remove, tasks)
+    if _unlinkat is None:
+        return results
+    return [error for errors in results for error in errors]
+
+
+def _folder_batches(filenames):
+    """ Return the `filenames` in (folder, [(name, filename), ...]) batches
+    of consecutive files of the same folder."""
+    batches = []
+    batch_folder = None
+    for filename in filenames:
+        folder, name = os.path.split(filename)
+        if folder != batch_folder:
+            batch_folder = folder
+            batch = []
+            batches.append((folder, batch))
+        batch.append((name, filename))
+    return batches
+
+
+def _remove_folder_files(batch):
+    """ Delete the files of a `_folder_batches` batch relative to their
+    folder descriptor. Return the error of each file."""
+    folder, names = batch
+    try:
+        folder_fd = _open_folder(folder)
+    except OSError, e:
+        if e.errno in (errno.ELOOP, errno.ENOTDIR):
+            # The folder was replaced by a link or a file.
+            return [e] * len(names)
+        return [_remove_file(filename) for name, filename in names]
+    stats.count('unlink', len(names))
+    try:
+        errors = []
+        for name, filename in names:
+            if _unlinkat(folder_fd, name, 0) == 0:
+                errors.append(None)
+            else:
+                errors.append(_libc_error(filename))
+        return errors
+    finally:
+        _close_folder(folder_fd)
+
+
+def _open_folder(path):
+    """ Return a descriptor of the folder at 'path'. A symbolic link is not
+    followed. Raise `OSError` if it cannot be opened."""
+    stats.count('open')
+    return os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+
+
+def _close_folder(folder_fd):
+    stats.count('close')
+    os.close(folder_fd)
+
+
+def _libc_error(path):
+    """ Return the error of the last failed C library call, about
+    'path'."""
+    error_number = ctypes.get_errno()
+    return OSError(error_number, os.strerror(error_number), path)
+
+
+def _remove_file(filename):
+    """ Delete a file. Return the error if it cannot be deleted."""
+    stats.count('unlink')
+    try:
+        os.remove(filename)
+    except:
+        if platform.system() == 'Windows':
+            stats.count('chmod')
+            stats.count('unlink')
+            try:
+                # Second try on Windows. Maybe the file was read
+                # only?
+                os.chmod(filename, stat.S_IWRITE)
+                os.remove(filename)
+            except:
+                return sys.exc_info()[1]
+        else:
+            return sys.exc_info()[1]
+    return None
+
+
+def _remove_folder(path):
+    """ Delete an empty folder. Return the error if it cannot be deleted."""
+    stats.count('rmdir')
+    try:
+        os.rmdir(path)
+    except:
+        return sys.exc_info()[1]
+    return None
+
+
+class FolderRemover(object):
+
+    """ Delete empty folders bottom-up relative to a descriptor of their
+    parent folder. Sibling folders share the parent descriptor: it stays open
+    until the parent is visited (see `release`). Without unlinkat, folders
+    are deleted by path."""
+
+    # Most parent descriptors kept open at once.
+    MAX_OPEN = 64
+
+    def __init__(self):
+        # Descriptors by folder path
+        self.folder_fds = {}
+
+    def remove(self, path):
+        """ Delete the empty folder at 'path'. Return the error if it cannot
+        be deleted."""
+        if _unlinkat is None:
+            return _remove_folder(path)
+        self.release(path)
+        parent, name = os.path.split(path)
+        folder_fd = self.folder_fds.get(parent)
+        if folder_fd is None:
+            if len(self.folder_fds) >= FolderRemover.MAX_OPEN:
+                self.close()
+            try:
+                folder_fd = self.folder_fds[parent] = _open_folder(parent)
+            except OSError, e:
+                if e.errno in (errno.ELOOP, errno.ENOTDIR):
+                    # The parent was replaced by a link or a file.
+                    return e
+                return _remove_folder(path)
+        stats.count('rmdir')
+        if _unlinkat(folder_fd, name, AT_REMOVEDIR) == 0:
+            return None
+        return _libc_error(path)
+
+    def release(self, path):
+        """ Close the descriptor of the folder at 'path', if open: no sub
+        folder of it is deleted anymore."""
+        folder_fd = self.folder_fds.pop(path, None)
+        if folder_fd is not None:
+            _close_folder(folder_fd)
+
+    def close(self):
+        """ Close all the descriptors."""
+        for path in self.folder_fds.keys():
+            self.release(path)
+
+
+class Inotify(object):
+
+    """ Watches of folders entries creation, deletion and renaming with the
+    Linux inotify(7) interface."""
+
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_EXCL_UNLINK = 0x4000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x80000
+
+    MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+    # struct inotify_event header: wd, mask, cookie, len
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        if _libc is None:
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.fd = _libc.inotify_init1(os.O_NONBLOCK | Inotify.IN_CLOEXEC)
+        if self.fd < 0:
+            raise _libc_error(None)
+        # Watched folder path by watch descriptor and the other way around.
+        self.paths = {}
+        self.watches = {}
+
+    def add(self, path):
+        """ Watch the folder at 'path'. Raise `OSError` if it cannot be
+        watched (e.g.: too many watches)."""
+        watch = _libc.inotify_add_watch(self.fd, path, Inotify.MASK)
+        if watch < 0:
+            raise _libc_error(path)
+        self.paths[watch] = path
+        self.watches[path] = watch
+
+    def remove_tree(self, path):
+        """ Stop watching the folder at 'path' and its sub folders."""
+        prefix = os.path.join(path, '')
+        for watched_path in self.watches.keys():
+            if watched_path == path or watched_path.startswith(prefix):
+                watch = self.watches.pop(watched_path)
+                del self.paths[watch]
+                _libc.inotify_rm_watch(self.fd, watch)
+
+    def read(self):
+        """ Return the pending events as (folder path, mask, name) tuples.
+        The path is None if the events queue overflowed."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                watch, mask, cookie, length = Inotify.EVENT.unpack_from(data, offset)
+                offset = offset + Inotify.EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset = offset + length
+                if mask & Inotify.IN_IGNORED:
+                    # Watched folder deleted
+                    path = self.paths.pop(watch, None)
+                    if self.watches.get(path) == watch:
+                        del self.watches[path]
+                elif mask & Inotify.IN_Q_OVERFLOW:
+                    events.append((None, mask, name))
+                elif watch in self.paths:
+                    events.append((self.paths[watch], mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class BackgroundTask(threading.Thread):
+
+    """ Run a function in a background thread and hold on its result."""
+
+    def __init__(self, function, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self._result = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self.function(*self.args)
+        except:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        """ Wait for the function to return and give back its result. Raise
+        again the exception if the function failed."""
+        self.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+def scan_tree(root, jobs=DEFAULT_JOBS, snapshot=None, excluded=None):
+    """ Walk the folder tree at 'root' path with a pool of `jobs` threads
+
+    :root: the top folder to walk
+    :jobs: number of folders listed in parallel
+    :snapshot: listings from a previous walk by folder path, with the folder
+    modification time: {path: (mtime, directories, files)}. A folder with the
+    same modification time is not listed again.
+    :excluded: function telling if a sub folder path is excluded. Excluded
+    folders are listed by their parent but their tree is not walked.
+    :returns: a generator over (path, directories, files) tuples, like
+    `os.walk()`, but in no particular order. Symbolic links to folders are not
+    followed and, except on Windows, are listed with the files. Folders that
+    cannot be read are skipped.
+
+    """
+    folders = Queue.Queue()
+    listings = Queue.Queue()
+    stopped = threading.Event()
+    workers = [threading.Thread(target=_scan_worker,
+                                args=(folders, listings, stopped, snapshot, excluded))
+               for i in range(max(1, jobs))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    folders.put(root)
+    pending = 1
+    try:
+        while pending:
+            path, directories, files, walked_count, exc_info = listings.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            pending = pending - 1
+            if directories is None:
+                continue
+            # Sub folders are queued by the worker right after this listing.
+            pending = pending + walked_count
+            yield path, directories, files
+    finally:
+        stopped.set()
+        for worker in workers:
+            folders.put(None)
+        for worker in workers:
+            worker.join()
+
+
+def _scan_worker(folders, listings, stopped, snapshot, excluded):
+    """ List folders taken from the `folders` queue until `stopped` is set.
+    The listing is posted in `listings` with the count of sub folders to walk.
+    These are queued back in `folders` after, so a folder is always posted
+    before its sub folders. If listing a folder fails, the exception info is
+    posted instead, to be raised again by the walk."""
+    while True:
+        path = folders.get()
+        if path is None or stopped.is_set():
+            return
+        try:
+            directories, files = _list_folder(path, snapshot)
+            sub_folders = [os.path.join(path, directory) for directory in directories or []]
+            if excluded:
+                sub_folders = [sub_folder for sub_folder in sub_folders
+                               if not excluded(sub_folder)]
+        except:
+            listings.put((path, None, None, 0, sys.exc_info()))
+            continue
+        listings.put((path, directories, files, len(sub_folders), None))
+        for sub_folder in sub_folders:
+            folders.put(sub_folder)
+
+
+def _list_folder(path, snapshot=None):
+    """ Return the names of the sub folders and of the files of the folder at
+    'path'. Return (None, None) if the folder cannot be read."""
+    if snapshot and path in snapshot:
+        (mtime, directories, files) = snapshot[path]
+        try:
+            status = os.lstat(path)
+        except OSError:
+            return None, None
+        stats.count('lstat')
+        if stat.S_ISDIR(status.st_mode) and status.st_mtime == mtime:
+            # No entry was added, removed or renamed since the snapshot.
+            return directories, files
+    directories = []
+    files = []
+    # Windows links to folders are followed like os.walk() does.
+    follow_symlinks = platform.system() == 'Windows'
+    stats.count('listdir')
+    try:
+        if scandir:
+            # The file type comes with the folder listing. No need to stat.
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    directories.append(entry.name)
+                else:
+                    files.append(entry.name)
+            return directories, files
+        names = os.listdir(path)
+    except OSError:
+        return None, None
+    stats.count('lstat', len(names))
+    for name in names:
+        try:
+            if follow_symlinks:
+                mode = os.stat(os.path.join(path, name)).st_mode
+            else:
+                mode = os.lstat(os.path.join(path, name)).st_mode
+        except OSError:
+            # Deleted since listed.
+            continue
+        if stat.S_ISDIR(mode):
+            directories.append(name)
+        else:
+            files.append(name)
+    return directories, files
+
+
+class TrackedIndex(object):
+
+    """ Index of the files tracked by Perforce, by folder.
+
+    Each folder path is kept once with the names of its tracked files, rather
+    than the full path of every file. Folders with tracked files anywhere in
+    their tree are indexed too, so a whole folder tree without tracked files
+    is told apart with a single lookup. Paths are expected normalized (see
+    `os.path.normpath` and `os.path.normcase`).
+
+    Names are appended to a list per folder while the index is filled.
+    `freeze()` then packs them in a sorted tuple without duplicates and shares
+    equal names (e.g.: Makefile) between folders.
+    """
+
+    __slots__ = ('folders', 'count')
+
+    # Names of the folders with no tracked files of their own.
+    NO_NAMES = ()
+
+    def __init__(self, filenames=()):
+        # Tracked file names by folder path.
+        self.folders = {}
+        # Files count. Files added twice are counted once frozen.
+        self.count = 0
+        if filenames:
+            for filename in filenames:
+                self.add(filename)
+            self.freeze()
+
+    def add(self, filename):
+        folder, name = os.path.split(filename)
+        names = self.folders.get(folder)
+        if names is None:
+            names = self.folders[folder] = []
+            self._add_parent_folders(folder)
+        elif not isinstance(names, list):
+            # Frozen
+            names = self.folders[folder] = list(names)
+        names.append(name)
+        self.count = self.count + 1
+
+    def freeze(self):
+        """ Pack the index in less memory. Files can still be added, at the
+        cost of unpacking their folder. Return the index."""
+        names_pool = {}
+        count = 0
+        for folder, names in self.folders.iteritems():
+            if not names:
+                self.folders[folder] = TrackedIndex.NO_NAMES
+                continue
+            if isinstance(names, list):
+                names.sort()
+                names = tuple([names_pool.setdefault(name, name)
+                               for index, name in enumerate(names)
+                               if not index or name != names[index - 1]])
+                self.folders[folder] = names
+            count = count + len(names)
+        self.count = count
+        return self
+
+    def copy(self):
+        """ Return a copy of the index. Frozen folders are shared until files
+        are added to them."""
+        index = TrackedIndex()
+        for folder, names in self.folders.iteritems():
+            if isinstance(names, list):
+                names = list(names)
+            index.folders[folder] = names
+        index.count = self.count
+        return index
+
+    def update(self, other):
+        """ Add all the files of the `other` index. """
+        for filename in other:
+            self.add(filename)
+
+    def _add_parent_folders(self, folder):
+        parent = os.path.dirname(folder)
+        while parent != folder and parent not in self.folders:
+            self.folders[parent] = TrackedIndex.NO_NAMES
+            folder, parent = parent, os.path.dirname(parent)
+
+    def has_tracked_files(self, folder):
+        """ Return True if files are tracked anywhere in the 'folder' tree."""
+        return folder in self.folders
+
+    def tracked_names(self, folder):
+        """ Return the set of the names of the files tracked in 'folder'. The
+        set is built on each call: look up all the names of a folder at
+        once."""
+        return frozenset(self.folders.get(folder, ()))
+
+    def __contains__(self, filename):
+        folder, name = os.path.split(filename)
+        names = self.folders.get(folder, ())
+        index = bisect.bisect_left(names, name)
+        return index < len(names) and names[index] == name
+
+    def __iter__(self):
+        for folder, names in self.folders.iteritems():
+            for name in names:
+                yield os.path.join(folder, name)
+
+    def __len__(self):
+        return self.count
+
+
+class AddedFilesIndex(object):
+
+    """ Index of the files tracked by Perforce, known by the files Perforce
+    would add (see `p4 reconcile -n -a`): any other local file is tracked,
+    opened, ignored or outside the client view. Same queries as
+    `TrackedIndex`.
+
+    Whether a folder tree has tracked files is not known: folders are never
+    told apart as untracked trees.
+    """
+
+    __slots__ = ('added_files',)
+
+    def __init__(self, added_files):
+        # `TrackedIndex` of the files to add.
+        self.added_files = added_files
+
+    def has_tracked_files(self, folder):
+        return True
+
+    def tracked_names(self, folder):
+        return _ComplementNames(self.added_files.tracked_names(folder))
+
+    def __contains__(self, filename):
+        return filename not in self.added_files
+
+    def __nonzero__(self):
+        return True
+
+
+class NewerFilesIndex(object):
+
+    """ Index of the files tracked by Perforce when only the files changed
+    since a time are cleaned: any file not changed is tracked. Same queries
+    as `TrackedIndex`.
+
+    `tracked_files` is the `TrackedIndex` of the folders with changed files,
+    `newer_names` the names of the changed files by folder path and
+    `new_folders` the folders whose files all changed.
+    """
+
+    __slots__ = ('tracked_files', 'newer_names', 'new_folders')
+
+    def __init__(self, tracked_files, newer_names, new_folders):
+        self.tracked_files = tracked_files
+        self.newer_names = newer_names
+        self.new_folders = new_folders
+
+    def has_tracked_files(self, folder):
+        return folder not in self.new_folders or \
+            self.tracked_files.has_tracked_files(folder)
+
+    def tracked_names(self, folder):
+        return _ComplementNames(self.newer_names.get(folder, frozenset()) -
+                                self.tracked_files.tracked_names(folder))
+
+    def __contains__(self, filename):
+        folder, name = os.path.split(filename)
+        return name not in self.newer_names.get(folder, ()) or \
+            filename in self.tracked_files
+
+    def __nonzero__(self):
+        return True
+
+
+class _ComplementNames(object):
+
+    """ Names not in a set."""
+
+    __slots__ = ('names',)
+
+    def __init__(self, names):
+        self.names = names
+
+    def __contains__(self, name):
+        return name not in self.names
 
 
 class Perforce(object):
 
     """ Interface to Perforce."""
 
+    # Severity of Perforce errors. Lower severities are warnings (e.g.: "no
+    # such file(s).").
+    E_FAILED = 3
+
+    CACHE_VERSION = 1
+
+    # First server version computing the files to add (`p4 reconcile -n -a`).
+    RECONCILE_SERVER_VERSION = 2012
+
+    # Folders queried by a single fstat command.
+    FSTAT_FOLDERS_BATCH = 100
+
+    # Generic code of the Perforce communication errors (e.g.: "Connect to
+    # server failed").
+    EV_COMM = 38
+
+    # Seconds before a failed command is run again, doubled on each retry.
+    RETRY_DELAY = 1.0
+
     def __init__(self):
+        self.use_cache = False
+        self.use_reconcile = False
+        self.version = None
+        self.timeout = DEFAULT_P4_TIMEOUT
+        self.retries = DEFAULT_P4_RETRIES
         try:
-            (version, root) = self.info()
+            with stats.phase('p4 info'):
+                (version, root, client) = self.info()
+            self.version = version
             self.root = os.path.normcase(os.path.normpath(root))
+            self.client = client
             self.available = True
         except:
             self.available = False
 
     @staticmethod
     def info():
-        """ Return perforce version and root."""
-        # get version
+        """ Return perforce version, client root and client name."""
         try:
-            info = shell_execute("p4 info")
+            records = list(Perforce._stream_records(["p4", "-G", "info"],
+                                                    DEFAULT_P4_TIMEOUT, DEFAULT_P4_RETRIES))
         except ShellExecuteException:
             logger.error("Perforce is unavailable!")
             raise
-        if not info:
+        if not records:
             logger.error("Perforce is unavailable!")
-            return (None, None)
-        root = None
+            return (None, None, None)
+        info = records[0]
         version = None
-        info_lines = info.lower().split('\n')
-        for information in info_lines:
-            if information.startswith('client root:'):
-                root = information[12:]
-                # filter space, line feed and line return.
-                root = root.strip(' /\r\n')
-            elif information.startswith('server version:'):
-                version = information[15:]
-                version = version.split('/')[2]
-                version = version.split('.')[0]
-                version = int(version)
-        return (version, root)
-
-    def is_inside_workspace(self):
-        """Return True if path inside current workspace."""
-        try:
-            where = shell_execute("p4 where")
-        except ShellExecuteException:
-            return False
-        if where is None:
+        if 'serverVersion' in info:
+            # e.g.: P4D/LINUX26X86_64/2013.1/610569 (2013/03/19)
+            version = info['serverVersion'].split('/')[2]
+            version = version.split('.')[0]
+            version = int(version)
+        # No client root if the client is unknown.
+        return (version, info.get('clientRoot'), info.get('clientName'))
+
+    def is_inside_workspace(self, path=None):
+        """Return True if 'path' (the current folder by default) is inside
+        the client workspace. Perforce is not queried again: the client root
+        from `info()` tells."""
+        if not self.available:
             return False
-        return True
+        if path is None:
+            path = os.getcwd()
+        for folder in (os.path.abspath(path), os.path.realpath(path)):
+            folder = os.path.normcase(folder)
+            if folder == self.root or folder.startswith(os.path.join(self.root, '')):
+                return True
+        return False
 
     def get_untracked_files(self, root):
         """ Return a list of untracked files at the 'root' path. """
-        fstat = self._get_perforce_fstat(root)
-        if not fstat:
+        # Perforce is queried while the local folder tree is walked. Folders
+        # are diffed as soon as Perforce answered.
+        tracked_task = BackgroundTask(self.get_tracked_files, root)
+        listings = []
+        untracked_files = []
+        for listing in scan_tree(root):
+            listings.append(listing)
+            if not tracked_task.is_alive():
+                tracked_files = tracked_task.result()
+                if not tracked_files:
+                    return []
+                untracked_files.extend(self._diff_listings(listings, tracked_files))
+                listings = []
+        tracked_files = tracked_task.result()
+        if not tracked_files:
             return []
-        depot_files = []
-        for line in fstat.splitlines():
-            if line:
-                depot_file = os.path.normcase(os.path.normpath(line.lstrip("... clientFile").strip()))
-                depot_files.append(depot_file)
-        local_files = []
-        for path, directories, files in os.walk(root):
-            for file in files:
-                local_file = os.path.normcase(os.path.join(path, file))
-                local_files.append(local_file)
-            if platform.system() != 'Windows':
-                # os.walk() treats symlinks to directories as if they
-                # are directories, but we need to treat them as files.
-                for directory in directories:
-                    local_folder = os.path.normcase(os.path.join(path, directory))
-                    if os.path.islink(local_folder):
-                        local_files.append(local_folder)
-        untracked_files = set(local_files) - set(depot_files)
-        return list(untracked_files)
-
-    def _get_perforce_fstat(self, root):
-        """ Return Perforce status for all files under 'root' path. """
-        result = ""
-        # Get all file at current version synced by the client (-Rh)
-        try:
-            fstat = shell_execute("p4 fstat -Rh -T clientFile " + os.path.join(root, "..."))
-            if fstat:
-                result = result + fstat
+        untracked_files.extend(self._diff_listings(listings, tracked_files))
+        return untracked_files
+
+    def _diff_listings(self, listings, tracked_files):
+        """ Return the untracked files of the folder `listings`. """
+        untracked_files = []
+        for path, directories, files in listings:
+            folder = os.path.normcase(path)
+            if tracked_files.has_tracked_files(folder):
+                tracked_names = tracked_files.tracked_names(folder)
+                untracked_files.extend([os.path.normcase(os.path.join(path, file))
+                                        for file in files
+                                        if os.path.normcase(file) not in tracked_names])
             else:
-                return None
+                # Nothing is tracked in this folder.
+                untracked_files.extend([os.path.normcase(os.path.join(path, file))
+                                        for file in files])
+        return untracked_files
+
+    def get_tracked_files(self, root):
+        """ Return the `TrackedIndex` of files tracked by Perforce at the
+        'root' path.
+
+        Return None if Perforce could not be queried.
+        """
+        if self.use_reconcile and self.can_reconcile():
+            return self._get_reconciled_files(root)
+        # Opened files are tracked to make sure file opened for add don't get
+        # cleaned.
+        if not self.use_cache:
+            return self._get_client_files(root)
+        # Files synced by the client (-Rh) and files opened (-Ro) are queried
+        # at the same time.
+        opened_task = BackgroundTask(self._get_depot_files, root, "-Ro")
+        have_files = self._get_cached_have_files(root)
+        opened_files = opened_task.result()
+        if not have_files or opened_files is None:
+            return None
+        have_files.update(opened_files)
+        return have_files.freeze()
+
+    def can_reconcile(self):
+        """ Return True if the server computes the files to add."""
+        return self.version is not None and \
+            self.version >= Perforce.RECONCILE_SERVER_VERSION
+
+    def _get_reconciled_files(self, root, require_synced=True):
+        """ Return the index of files tracked at the 'root' path as an
+        `AddedFilesIndex`: the server and client compute the local files to
+        add in a single `p4 reconcile -n -a`, with the P4IGNORE rules. Nothing
+        is opened.
+
+        Return None if Perforce could not be queried or, if `require_synced`,
+        if no file is synced.
+        """
+        if require_synced:
+            synced_task = BackgroundTask(self.has_synced_files, root)
+        added_files = TrackedIndex()
+        try:
+            with stats.phase('p4 reconcile'):
+                for record in self._iter_records(["p4", "-G", "reconcile", "-n", "-a",
+                                                  os.path.join(root, "...")]):
+                    if record.get('action') == 'add' and 'clientFile' in record:
+                        added_files.add(os.path.normcase(os.path.normpath(record['clientFile'])))
+        except ShellExecuteException:
+            logger.error("Perforce is unavailable:")
+            return None
+        if require_synced and not synced_task.result():
+            return None
+        return AddedFilesIndex(added_files.freeze())
+
+    def get_folders_tracked_files(self, folders):
+        """ Return the index of files synced or opened by the client
+        directly in `folders` (not in their sub folders).
+
+        Return None if Perforce could not be queried.
+        """
+        result = self._get_paths_client_files([os.path.join(folder, "*") for folder in folders])
+        if result is None:
+            return None
+        return result[0]
+
+    def get_roots_tracked_files(self, roots):
+        """ Return the index of files synced or opened by the client in the
+        `roots` trees, fetched together, and the set of roots with synced
+        files.
+
+        Return None if Perforce could not be queried.
+        """
+        result = self._get_paths_client_files([os.path.join(root, "...") for root in roots])
+        if result is None:
+            return None
+        (client_files, have_folders) = result
+        synced_roots = set()
+        for root in roots:
+            prefix = os.path.join(os.path.normcase(root), '')
+            for folder in have_folders:
+                if folder == prefix[:-1] or folder.startswith(prefix):
+                    synced_roots.add(root)
+                    break
+        return client_files, synced_roots
+
+    def _get_paths_client_files(self, paths):
+        """ Return the index of files synced or opened by the client at the
+        fstat `paths` (e.g.: /root/folder/* or /root/folder/...) and the set
+        of the folders with synced files. Synced files (-Rh) and opened
+        files (-Ro) are queried at the same time.
+
+        Return None if Perforce could not be queried.
+        """
+        opened_task = BackgroundTask(self._get_paths_depot_files, paths, "-Ro")
+        have_files = self._get_paths_depot_files(paths, "-Rh")
+        opened_files = opened_task.result()
+        if have_files is None or opened_files is None:
+            return None
+        have_folders = set([folder for (folder, names) in have_files.folders.iteritems() if names])
+        have_files.update(opened_files)
+        return have_files.freeze(), have_folders
+
+    def _get_paths_depot_files(self, paths, option):
+        """ Return the index of files known by Perforce at the fstat `paths`.
+        `option` is the fstat -R filter. Paths are queried
+        `FSTAT_FOLDERS_BATCH` at a time in each fstat command.
+
+        Return None if Perforce could not be queried.
+        """
+        depot_files = TrackedIndex()
+        try:
+            with stats.phase('p4 fstat %s' % option):
+                for index in xrange(0, len(paths), Perforce.FSTAT_FOLDERS_BATCH):
+                    for record in self._iter_records(["p4", "-G", "fstat", option, "-T", "clientFile"] +
+                                                     paths[index:index + Perforce.FSTAT_FOLDERS_BATCH]):
+                        depot_files.add(os.path.normcase(os.path.normpath(record['clientFile'])))
         except ShellExecuteException:
             logger.error("Perforce is unavailable:")
             return None
-        # Add all opened files. This will make sure file opened for add don't
-        # get cleaned
+        return depot_files
+
+    def has_synced_files(self, root):
+        """ Return True if files are synced by the client at the 'root'
+        path. Return False if Perforce could not be queried."""
         try:
-            fstat = shell_execute("p4 fstat -Ro -T clientFile " + os.path.join(root, "..."))
-            if fstat:
-                result = result + fstat
-            else:
-                return None
+            with stats.phase('p4 fstat'):
+                for record in self._iter_records(["p4", "-G", "fstat", "-m", "1", "-Rh",
+                                                  "-T", "clientFile", os.path.join(root, "...")]):
+                    return True
         except ShellExecuteException:
             logger.error("Perforce is unavailable:")
+        return False
+
+    def _get_client_files(self, root, recursive=True, require_synced=True):
+        """ Return the index of files synced or opened by the client at the
+        'root' path. Synced files (-Rh) and opened files (-Ro) are queried at
+        the same time. If not `recursive`, only the files directly in root
+        are fetched.
+
+        Return None if Perforce could not be queried or, if `require_synced`,
+        if no file is synced.
+        """
+        opened_task = BackgroundTask(self._get_depot_files, root, "-Ro", recursive)
+        have_files = self._get_depot_files(root, "-Rh", recursive)
+        opened_files = opened_task.result()
+        if have_files is None or opened_files is None:
             return None
-        return result
+        if require_synced and not have_files:
+            return None
+        have_files.update(opened_files)
+        return have_files.freeze()
+
+    def _get_depot_files(self, root, option, recursive=True):
+        """ Return the index of files known by Perforce at the 'root' path.
+        `option` is the fstat -R filter. If not `recursive`, only the files
+        directly in root are fetched.
+
+        Return None if Perforce could not be queried.
+        """
+        depot_files = TrackedIndex()
+        try:
+            with stats.phase('p4 fstat %s' % option):
+                for record in self._get_perforce_fstat(root, option, ('clientFile',), recursive):
+                    depot_file = os.path.normcase(os.path.normpath(record['clientFile']))
+                    depot_files.add(depot_file)
+        except ShellExecuteException:
+            logger.error("Perforce is unavailable:")
+            return None
+        return depot_files
+
+    def _get_cached_have_files(self, root):
+        """ Return the index of files synced by the client at the 'root' path.
+        The have list cached by the last call is reused if the client was not
+        synced since.
+
+        Return None if Perforce could not be queried.
+        """
+        key = self._get_have_cache_key(root)
+        if key is not None:
+            have_files = self._load_have_cache(root, key)
+            if have_files is not None:
+                return have_files
+        have_files = self._get_depot_files(root, "-Rh")
+        if have_files and key is not None:
+            self._save_have_cache(root, key, have_files)
+        return have_files
+
+    def _get_have_cache_key(self, root):
+        """ Return the key of the have list at the 'root' path: the client
+        name, the highest synced changelist, the synced files count and
+        their total size. The size tells apart a sync removing a file and
+        adding another at an older changelist.
+
+        Return None if Perforce could not be queried.
+        """
+        path = os.path.join(root, "...#have")
+        count_task = BackgroundTask(self._get_records,
+                                    ["p4", "-G", "sizes", "-s", path])
+        try:
+            with stats.phase('p4 have cache key'):
+                changes = self._get_records(["p4", "-G", "changes", "-m1", "-s", "submitted", path])
+                sizes = count_task.result()
+        except ShellExecuteException:
+            return None
+        if not changes or not sizes:
+            return None
+        return (self.client, int(changes[0]['change']), int(sizes[0]['fileCount']),
+                int(sizes[0]['fileSize']))
+
+    def _cache_file_path(self):
+        return os.path.join(self.root, CACHE_FILENAME)
+
+    def _load_have_cache(self, root, key):
+        """ Return the cached have list at the 'root' path. Return None if
+        not cached under this `key`."""
+        try:
+            (version, cache_root, cache_key, files) = load_marshal_file(self._cache_file_path())
+        except (TypeError, ValueError):
+            return None
+        root = os.path.normcase(root)
+        if version != Perforce.CACHE_VERSION or cache_root != root or cache_key != key:
+            return None
+        return TrackedIndex([os.path.join(root, file) for file in files])
+
+    def _save_have_cache(self, root, key, have_files):
+        """ Save the have list at the 'root' path under `key`. Paths are
+        saved sorted and relative to root."""
+        root = os.path.normcase(root)
+        prefix_length = len(os.path.join(root, ''))
+        files = sorted([file[prefix_length:] for file in have_files])
+        cache_path = self._cache_file_path()
+        if not save_marshal_file(cache_path, (Perforce.CACHE_VERSION, root, key, files)):
+            logger.error("Cannot save the have list cache at '%s'" % cache_path)
+
+    def _get_perforce_fstat(self, root, option, fields=('clientFile',), recursive=True):
+        """ Stream Perforce status for all files under 'root' path. `option`
+        is the fstat -R filter (e.g.: -Rh for synced files, -Ro for opened
+        files). `fields` are the fstat fields (e.g.: clientFile, headAction,
+        action) to fetch in the same query. If not `recursive`, only the
+        files directly in root are streamed.
+
+        Yield one dictionary of fields per file. Raise
+        `ShellExecuteException` if Perforce fails or does not answer.
+        """
+        command = ["p4", "-G", "fstat", option]
+        if recursive:
+            path = os.path.join(root, "...")
+        else:
+            path = os.path.join(root, "*")
+        command.extend(["-T", ",".join(fields), path])
+        return self._iter_records(command)
+
+    def _get_records(self, command):
+        """ Return the list of records of a `p4 -G` command."""
+        return list(self._iter_records(command))
+
+    def _iter_records(self, command):
+        """ Stream the records of a `p4 -G` command, with the `timeout` and
+        `retries` of this Perforce interface (see `_stream_records`)."""
+        return Perforce._stream_records(command, self.timeout, self.retries)
+
+    @staticmethod
+    def _stream_records(command, timeout=None, retries=0):
+        """ Stream the records of a `p4 -G` command. Warnings are skipped.
+
+        The command is stopped if it outputs nothing for `timeout` seconds.
+        A command stopped or failing on a communication error is run again
+        up to `retries` times, after a delay doubled on each retry. The
+        records streamed before the failure are streamed again.
+
+        Raise `ShellExecuteException` if Perforce fails or does not answer.
+        """
+        attempt = 0
+        while True:
+            try:
+                for record in Perforce._stream_command_records(command, timeout):
+                    yield record
+                return
+            except TransientShellException:
+                if attempt >= retries:
+                    raise
+                delay = Perforce.RETRY_DELAY * 2 ** attempt
+                attempt = attempt + 1
+                logger.warning("Perforce command `%s` failed: retry %d of %d in %s seconds" %
+                               (" ".join(command), attempt, retries, delay))
+                stats.count('p4 retries')
+                time.sleep(delay)
+
+    @staticmethod
+    def _stream_command_records(command, timeout):
+        """ Stream the records of a single run of a `p4 -G` command."""
+        answered = False
+        for record in shell_marshal(command, timeout=timeout):
+            answered = True
+            if record.get('code') == 'stat':
+                yield record
+            elif record.get('code') == 'error' and \
+                    int(record.get('severity', Perforce.E_FAILED)) >= Perforce.E_FAILED:
+                logger.error(record.get('data', '').strip())
+                if int(record.get('generic', 0)) == Perforce.EV_COMM:
+                    raise TransientShellException
+                raise ShellExecuteException
+        if not answered:
+            raise ShellExecuteException
+
+
+class ExclusionMatcher(object):
+
+    """ Match paths against a list of `fnmatch` patterns.
+
+    Patterns are sorted by shape so most of them are matched without a regular
+    expression:
+
+    - `name`: literal path, a set lookup.
+    - `*.ext`: extension, a set lookup on the path extension.
+    - `*suffix`: literal suffix (e.g.: `*/.p4clean`), `str.endswith`.
+    - `prefix*`: literal prefix (e.g.: `/folder/build*`), `str.startswith`.
+    - `*part*`: literal part (e.g.: `*/.git*`), a substring search.
+
+    Any other pattern is joined in a single regular expression.
+    """
+
+    WILDCARDS = re.compile(r'[*?[]')
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.literals = set()
+        self.extensions = set()
+        suffixes = []
+        prefixes = []
+        self.parts = []
+        expressions = []
+        for pattern in patterns:
+            if not self.WILDCARDS.search(pattern):
+                self.literals.add(pattern)
+                continue
+            head, star, tail = pattern.rpartition('*')
+            if not self.WILDCARDS.search(tail):
+                if head == '':
+                    if tail.startswith('.') and '.' not in tail[1:] and \
+                            '/' not in tail and os.sep not in tail:
+                        self.extensions.add(tail)
+                    else:
+                        suffixes.append(tail)
+                    continue
+                if tail == '':
+                    if head.startswith('*') and not self.WILDCARDS.search(head[1:]):
+                        self.parts.append(head[1:])
+                        continue
+                    if not self.WILDCARDS.search(head):
+                        prefixes.append(head)
+                        continue
+            expressions.append(fnmatch.translate(pattern))
+        self.suffixes = tuple(suffixes)
+        self.prefixes = tuple(prefixes)
+        self.regex = None
+        if expressions:
+            self.regex = re.compile(r'|'.join(expressions))
+
+    def match(self, path):
+        """ Return True if 'path' matches any pattern."""
+        if path in self.literals:
+            return True
+        if self.extensions:
+            dot = path.rfind('.')
+            if dot >= 0 and path[dot:] in self.extensions:
+                return True
+        if self.suffixes and path.endswith(self.suffixes):
+            return True
+        if self.prefixes and path.startswith(self.prefixes):
+            return True
+        for part in self.parts:
+            if part in path:
+                return True
+        if self.regex:
+            return self.regex.match(path) is not None
+        return False
 
 
 class P4CleanConfig(object):
 
-    """Configurations for processing the p4 depot clean up process."""
+    """Configurations for processing the p4 depot clean up process.
+
+    Like .gitignore files, the exclusion patterns of a .p4clean file apply
+    to its whole folder tree, in addition to the patterns of the .p4clean
+    files above. The matcher of each folder is looked up once, then cached:
+    folders without a .p4clean file share their parent matcher.
+    """
 
     SECTION_NAME = 'p4clean'
     CONFIG_FILENAME = '.p4clean'
     EXCLUSION_OPTION = 'exclude'
 
-    def __init__(self, perforce_root, exclusion=None):
-        """  """
-        # Look for the .p4clean file.
+    def __init__(self, perforce_root, exclusion=None, path=None):
+        """ The .p4clean files are looked for from the perforce root down to
+        'path' (the current folder by default), then in the sub folders of
+        'path' as they are matched."""
+        if path is None:
+            path = os.getcwd()
+        # Look for the .p4clean files.
         config_exclusion_list = []
-        config_path = self._config_file_path(perforce_root)
-        if config_path:
-            config_exclusion_list = self._parse_config_file(config_path)
+        for config_path in self._config_file_paths(perforce_root, path):
+            config_exclusion_list.extend(self._parse_config_file(config_path))
 
         args_exclusion_list = []
         if exclusion:
@@ -185,29 +1497,62 @@ class P4CleanConfig(object):
 
         # chain args and config file exclusion lists
         exclusion_list = args_exclusion_list + config_exclusion_list
-        # Exlude p4clean config file
+        # Exlude p4clean config, cache and snapshot files
         exclusion_list.append(os.path.join('*', P4CleanConfig.CONFIG_FILENAME))
-        self.exclusion_regex = self._compute_regex(exclusion_list)
+        exclusion_list.append(os.path.join('*', CACHE_FILENAME))
+        exclusion_list.append(os.path.join('*', SNAPSHOT_FILENAME))
+        self.matcher = ExclusionMatcher(exclusion_list)
+        self.path = os.path.normcase(os.path.abspath(path))
+        # Matcher by normalized folder path, under path.
+        self.matchers = {self.path: self.matcher}
 
     def is_excluded(self, filename):
-        return self.exclusion_regex.match(filename) is not None
+        # Files are matched normalized (see `os.path.normcase`) or not.
+        return self._folder_matcher(os.path.normcase(os.path.dirname(filename))).match(filename)
+
+    def _folder_matcher(self, folder):
+        """ Return the matcher of the files in the normalized 'folder'.
+        Folders outside the config path tree get the matcher of the config
+        path."""
+        matcher = self.matchers.get(folder)
+        if matcher is not None:
+            return matcher
+        parent = os.path.dirname(folder)
+        if parent == folder or not folder.startswith(os.path.join(self.path, '')):
+            return self.matcher
+        matcher = self._folder_matcher(parent)
+        config_file = os.path.join(folder, P4CleanConfig.CONFIG_FILENAME)
+        if os.path.exists(config_file):
+            matcher = ExclusionMatcher(matcher.patterns + self._parse_config_file(config_file))
+        self.matchers[folder] = matcher
+        return matcher
 
-    def _compute_regex(self, exclusion_list):
-        return re.compile(r'|'.join([fnmatch.translate(x) for x in exclusion_list]) or r'$.')
+    def _config_file_path(self, root, path=None):
+        """ Return the absolute path of the config file nearest to 'path'.
+        Return None if non-existent."""
+        config_files = self._config_file_paths(root, path)
+        if not config_files:
+            return None
+        return config_files[-1]
 
-    def _config_file_path(self, root):
-        """ Return absolute config file path. Return None if non-existent."""
-        path = os.getcwd()
-        root = os.path.abspath(root)
+    def _config_file_paths(self, root, path=None):
+        """ Return the absolute paths of the config files from the 'root'
+        folder down to 'path' (the current folder by default)."""
+        if path is None:
+            path = os.getcwd()
+        root = os.path.normcase(os.path.abspath(root))
+        path = os.path.abspath(path)
+        config_files = []
         while True:
-            config_file = os.path.join(path, '.p4clean')
+            config_file = os.path.join(path, P4CleanConfig.CONFIG_FILENAME)
             if os.path.exists(config_file):
-                return config_file
-            else:
-                if path.lower() == root.lower() or path == '/':
-                    return None
-                else:
-                    path = os.path.dirname(path)
+                config_files.append(config_file)
+            parent = os.path.dirname(path)
+            if os.path.normcase(path) == root or parent == path:
+                break
+            path = parent
+        config_files.reverse()
+        return config_files
 
     def _parse_config_file(self, path):
         """ Return exclusion list from a config file. """
@@ -229,14 +1574,74 @@ class P4CleanConfig(object):
         except ConfigParser.NoOptionError:
             logger.error("Invalid p4clean config file: No option named \"%s\" found." % P4CleanConfig.EXCLUSION_OPTION)
             return []
+        except (ConfigParser.Error, IOError), e:
+            # e.g.: no section header. Nested config files are parsed by the
+            # folder listing threads: the error must not stop them.
+            logger.error("Invalid p4clean config file '%s': %s" % (path, e))
+            return []
+
+
+class UntrackedEntry(object):
+
+    """ File or folder a clean would delete. The size and link type are read
+    from the file system on first use."""
+
+    __slots__ = ('path', 'reason', 'is_dir', '_status')
+
+    # Reasons to delete an entry.
+    UNTRACKED_FILE = 'untracked file'
+    UNTRACKED_TREE = 'untracked tree'
+    EMPTY_FOLDER = 'empty folder'
+
+    def __init__(self, path, reason, is_dir=False):
+        self.path = path
+        self.reason = reason
+        self.is_dir = is_dir
+        self._status = None
+
+    def _lstat(self):
+        """ Return the entry status. Return None if it is gone."""
+        if self._status is None:
+            try:
+                self._status = os.lstat(self.path)
+            except OSError:
+                self._status = False
+        return self._status or None
+
+    @property
+    def is_link(self):
+        status = self._lstat()
+        return status is not None and stat.S_ISLNK(status.st_mode)
+
+    @property
+    def size(self):
+        """ Size in bytes. None if the entry is gone."""
+        status = self._lstat()
+        if status is None:
+            return None
+        return status.st_size
+
+    def __repr__(self):
+        return "UntrackedEntry(%r, %r, is_dir=%r)" % (self.path, self.reason, self.is_dir)
 
 
 class P4Clean:
 
-    def __init__(self):
+    SNAPSHOT_VERSION = 1
+    # Modification time resolution of file systems (FAT is 2 seconds).
+    # Folders changed that close to a walk are always listed again.
+    MTIME_RESOLUTION = 2
+
+    def __init__(self, perforce=None):
         self.dry_run = False
+        self.incremental = False
+        self.newer_than = None
+        self.jobs = DEFAULT_JOBS
+        self.processes = 1
         self.config = None
-        self.perforce = Perforce()
+        if perforce is None:
+            perforce = Perforce()
+        self.perforce = perforce
 
     def run(self):
         """ Restore current working folder and subfolder to orginal state."""
@@ -253,27 +1658,101 @@ class P4Clean:
         parser.add_argument('-e', '--exclude',
                             default=None,
                             help="semicolon separated exclusion pattern (e.g.: *.txt;*.log;")
+        parser.add_argument('-c', '--cache',
+                            action='store_true',
+                            help="reuse the list of synced files saved by the last run if the workspace was not synced since")
+        parser.add_argument('-i', '--incremental',
+                            action='store_true',
+                            help="only list again the folders changed since the last run")
+        parser.add_argument('--newer-than',
+                            metavar='TIME|FILE',
+                            type=parse_newer_than,
+                            default=None,
+                            help="only clean the files changed since TIME (seconds since epoch or YYYY-MM-DD[ HH:MM[:SS]]) or since FILE was modified")
+        parser.add_argument('-j', '--jobs',
+                            type=int,
+                            default=DEFAULT_JOBS,
+                            help="number of folders listed and files deleted in parallel (default: %d)" % DEFAULT_JOBS)
+        parser.add_argument('-r', '--reconcile',
+                            action='store_true',
+                            help="ask the server for the files to add with 'p4 reconcile -n -a' (2012.1+ servers): files ignored by P4IGNORE or outside the client view are kept")
+        parser.add_argument('-p', '--processes',
+                            type=int,
+                            default=1,
+                            help="clean each top level folder in one of PROCESSES worker processes (default: 1, not with --incremental)")
+        parser.add_argument('-w', '--watch',
+                            action='store_true',
+                            help="run a service watching the current folder tree (Linux only), for --query")
+        parser.add_argument('--query',
+                            action='store_true',
+                            help="print what would be deleted, as known by the --watch service of the current folder")
+        parser.add_argument('--timeout',
+                            type=float,
+                            default=DEFAULT_P4_TIMEOUT,
+                            help="stop a Perforce command with no output for TIMEOUT seconds (default: %d, 0: never)" % DEFAULT_P4_TIMEOUT)
+        parser.add_argument('--retries',
+                            type=int,
+                            default=DEFAULT_P4_RETRIES,
+                            help="run a Perforce command stopped or failing on a lost connection up to RETRIES times again (default: %d)" % DEFAULT_P4_RETRIES)
+        parser.add_argument('--stats',
+                            action='store_true',
+                            help="print the time spent in each phase, the system calls count and the peak memory")
+        parser.add_argument('--stats-json',
+                            metavar='FILE',
+                            default=None,
+                            help="save the --stats values as JSON in FILE")
+        parser.add_argument('paths',
+                            nargs='*',
+                            metavar='PATH',
+                            help="folders to clean (default: the current folder)")
         parser.add_argument('-v', '--version',
                             action='version',
                             version="p4clean version %s" % __version__)
         args = parser.parse_args()
 
         self.dry_run = args.dry_run
+        self.perforce.use_cache = args.cache
+        self.perforce.use_reconcile = args.reconcile
+        self.perforce.timeout = max(0, args.timeout)
+        self.perforce.retries = max(0, args.retries)
+        if args.reconcile and not self.perforce.can_reconcile():
+            logger.error("The Perforce server cannot reconcile: tracked files are listed instead.")
+        self.incremental = args.incremental
+        self.newer_than = args.newer_than
+        self.jobs = max(1, args.jobs)
+        self.processes = max(1, args.processes)
         if args.quiet:
             logger.setLevel(logging.ERROR)
         else:
             logger.setLevel(logging.INFO)
 
-        if not self.perforce.is_inside_workspace():
-            logger.error(
-                "Nothing to clean: Current folder is not inside a Perforce workspace. Validate your perforce workspace with the command 'p4 where' or configure you command line workspace.")
-            return
-
-        self.config = P4CleanConfig(self.perforce.root, args.exclude)
-
-        (deleted_files_count, file_error_msgs) = self.delete_untracked_files()
+        roots = [os.path.abspath(path) for path in args.paths] or [os.getcwd()]
+        for root in roots:
+            if not os.path.isdir(root):
+                logger.error("Nothing to clean: '%s' is not a folder." % root)
+                return
+            if not self.perforce.is_inside_workspace(root):
+                logger.error(
+                    "Nothing to clean: '%s' is not inside a Perforce workspace. Validate your perforce workspace with the command 'p4 where' or configure you command line workspace." % root)
+                return
+        roots = remove_nested_paths(roots)
 
-        (empty_folders_deleted_count, folder_error_msgs) = self.delete_empty_folders()
+        if len(roots) > 1:
+            if args.watch or args.query:
+                logger.error("Only one folder can be watched or queried.")
+                return
+            (deleted_files_count, file_error_msgs,
+             empty_folders_deleted_count, folder_error_msgs) = self.clean_roots(roots, args.exclude)
+        else:
+            self.config = P4CleanConfig(self.perforce.root, args.exclude, roots[0])
+            if args.watch:
+                self.watch(roots[0])
+                return
+            if args.query:
+                self.query(roots[0])
+                return
+            (deleted_files_count, file_error_msgs,
+             empty_folders_deleted_count, folder_error_msgs) = self.clean(roots[0])
 
         if self.dry_run:
             logger.info(80 * "-")
@@ -294,54 +1773,897 @@ class P4Clean:
                 logger.error("%s empty folders could not be deleted" % len(folder_error_msgs))
                 logger.error("\n".join(folder_error_msgs))
 
+        if args.stats:
+            print stats.format()
+        if args.stats_json and not stats.save(args.stats_json):
+            logger.error("Cannot save the stats at '%s'" % args.stats_json)
+
+    def clean(self, root):
+        """Delete untracked files and empty folders under root (excluding
+        root) in a single walk of the folder tree.
+
+        Return the deleted files count, the files error messages, the deleted
+        folders count and the folders error messages.
+        """
+        if self.newer_than is not None:
+            return self._clean_newer(root)
+        if self.processes > 1 and not self.incremental:
+            return self._clean_shards(root)
+        snapshot = None
+        if self.incremental:
+            snapshot = self._load_snapshot(root)
+        # Perforce is queried while the local folder tree is walked.
+        tracked_task = BackgroundTask(self.perforce.get_tracked_files, root)
+        walk_time = time.time()
+        listings = self._get_listings(root, snapshot)
+        tracked_files = tracked_task.result()
+        result = self._clean_listings(root, listings, tracked_files)
+        if self.incremental and not self.dry_run:
+            self._save_snapshot(root, walk_time, listings)
+        return result
+
+    def clean_roots(self, roots, exclusion=None):
+        """ Clean several folders, each with its own config, in a single
+        Perforce session. `roots` must not be nested. By default, Perforce is
+        queried once for all of them while their trees are walked at the
+        same time. Return the same as `clean`, for all of the roots."""
+        cleaners = []
+        for root in roots:
+            cleaner = copy.copy(self)
+            cleaner.config = P4CleanConfig(self.perforce.root, exclusion, root)
+            cleaners.append(cleaner)
+        if self.newer_than is not None or self.incremental or self.processes > 1 or \
+                self.perforce.use_cache or self.perforce.use_reconcile:
+            # These modes query Perforce by root.
+            results = [cleaner.clean(root) for cleaner, root in zip(cleaners, roots)]
+        else:
+            tracked_task = BackgroundTask(self.perforce.get_roots_tracked_files, roots)
+            walk_tasks = [BackgroundTask(cleaner._get_listings, root)
+                          for cleaner, root in zip(cleaners, roots)]
+            tracked = tracked_task.result()
+            results = []
+            for cleaner, root, walk_task in zip(cleaners, roots, walk_tasks):
+                tracked_files = None
+                if tracked is not None and root in tracked[1]:
+                    tracked_files = tracked[0]
+                results.append(cleaner._clean_listings(root, walk_task.result(), tracked_files))
+        deleted_files_count = 0
+        file_error_msgs = []
+        deleted_folders_count = 0
+        folder_error_msgs = []
+        for result in results:
+            deleted_files_count = deleted_files_count + result[0]
+            file_error_msgs.extend(result[1])
+            deleted_folders_count = deleted_folders_count + result[2]
+            folder_error_msgs.extend(result[3])
+        return (deleted_files_count, file_error_msgs,
+                deleted_folders_count, folder_error_msgs)
+
+    def _clean_newer(self, root):
+        """ Clean the files of root changed since `newer_than` and the
+        folders left empty. Perforce is only queried about the folders with
+        changed files, once the folder tree is walked. Return the same as
+        `clean`."""
+        synced_task = BackgroundTask(self.perforce.has_synced_files, root)
+        listings = self._get_listings(root)
+        (newer_names, new_folders) = self._get_newer_names(listings)
+        tracked_files = self.perforce.get_folders_tracked_files(
+            sorted([folder for folder, names in newer_names.iteritems() if names]))
+        has_synced_files = synced_task.result()
+        if tracked_files is None or not has_synced_files:
+            tracked_files = None
+        else:
+            tracked_files = NewerFilesIndex(tracked_files, newer_names, new_folders)
+        return self._clean_listings(root, listings, tracked_files, newer_names)
+
+    def _get_newer_names(self, listings):
+        """ Return the names of the files changed since `newer_than` by
+        folder path, for the folders changed since, and the set of folders
+        whose files all changed. Paths and names are normalized.
+
+        Files are only checked in the changed folders: creating, renaming or
+        deleting a file changes the modification time of its folder. Files
+        rewritten in place in an unchanged folder are not seen.
+        """
+        newer_names = {}
+        new_folders = set()
+        with stats.phase('mtime'):
+            for path, (directories, files) in listings.iteritems():
+                if not self._is_newer(path):
+                    continue
+                names = [file for file in files
+                         if self._is_newer(os.path.join(path, file))]
+                folder = os.path.normcase(path)
+                newer_names[folder] = frozenset([os.path.normcase(name) for name in names])
+                if len(names) == len(files):
+                    new_folders.add(folder)
+        return newer_names, new_folders
+
+    def _is_newer(self, path):
+        """ Return True if 'path' was modified since `newer_than`. Symbolic
+        links are not followed."""
+        stats.count('lstat')
+        try:
+            return os.lstat(path).st_mtime >= self.newer_than
+        except OSError:
+            # Deleted since listed.
+            return False
+
+    def _clean_shards(self, root):
+        """ Clean each top level folder of root (a shard) in a pool of
+        `processes` worker processes, then the files of root. Perforce is
+        queried by shard, in the worker. Return the same as `clean`."""
+        synced_task = BackgroundTask(self.perforce.has_synced_files, root)
+        root_tracked_task = BackgroundTask(self.perforce._get_client_files, root, False, False)
+        directories, files = _list_folder(root)
+        has_synced_files = synced_task.result()
+        root_tracked_files = root_tracked_task.result()
+        if directories is None or not has_synced_files:
+            # Nothing to share out or no file is deleted: in a single process.
+            return self._clean_listings(root, self._get_listings(root), None)
+        shards = [os.path.join(root, directory) for directory in directories
+                  if not self.config.is_excluded(os.path.join(root, directory))]
+        deleted_files_count = 0
+        file_error_msgs = []
+        deleted_folders_count = 0
+        folder_error_msgs = []
+        listings = {root: (directories, files)}
+        pool = multiprocessing.Pool(max(1, min(self.processes, len(shards))))
+        try:
+            # Results are merged as shards are done.
+            for result in pool.imap_unordered(_clean_shard,
+                                              [(self, shard, logger.level) for shard in shards]):
+                (shard, shard_result, is_empty, shard_stats) = result
+                deleted_files_count = deleted_files_count + shard_result[0]
+                file_error_msgs.extend(shard_result[1])
+                deleted_folders_count = deleted_folders_count + shard_result[2]
+                folder_error_msgs.extend(shard_result[3])
+                stats.merge(shard_stats)
+                if is_empty:
+                    # Deleted with the files of root.
+                    listings[shard] = ([], [])
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        result = self._clean_listings(root, listings, root_tracked_files)
+        return (deleted_files_count + result[0], file_error_msgs + result[1],
+                deleted_folders_count + result[2], folder_error_msgs + result[3])
+
+    def iter_untracked(self, root):
+        """ Return a generator over the `UntrackedEntry` of the files and
+        folders a clean of root would delete, bottom-up. Nothing is deleted
+        or logged. Raise `ShellExecuteException` if Perforce could not be
+        queried."""
+        tracked_task = BackgroundTask(self.perforce.get_tracked_files, root)
+        listings = self._get_listings(root)
+        tracked_files = tracked_task.result()
+        if tracked_files is None:
+            raise ShellExecuteException
+        return self._untracked_entries(root, listings, tracked_files)
+
+    def _untracked_entries(self, root, listings, tracked_files):
+        """ Yield the `UntrackedEntry` of the files and folders a clean of
+        the folder `listings` of root would delete, bottom-up."""
+        with stats.phase('diff'):
+            (untracked_files, untracked_trees, untracked_tree_files) = \
+                self._find_untracked(root, listings, tracked_files)
+        # Untracked files by folder path. They are all taken as deleted.
+        folder_files = {}
+        deleted_names = {}
+        for path, file, filename in untracked_files + untracked_tree_files:
+            folder_files.setdefault(path, []).append(filename)
+            deleted_names.setdefault(path, set()).add(file)
+        for path, directories, files, reason in self._plan_folders(root, listings, untracked_trees,
+                                                                    deleted_names):
+            for filename in folder_files.get(path, []):
+                yield UntrackedEntry(filename, UntrackedEntry.UNTRACKED_FILE)
+            if reason is not None:
+                parent, name = os.path.split(path)
+                deleted_names.setdefault(parent, set()).add(name)
+                yield UntrackedEntry(path, reason, is_dir=True)
+
+    def watch(self, root):
+        """ Run the watch service of root until interrupted."""
+        if not hasattr(socket, 'AF_UNIX'):
+            # e.g.: on Windows
+            logger.error("Cannot watch '%s' (the watch service is only available on Linux)" % root)
+            return
+        watcher = Watcher(self, root, watch_socket_path(root))
+        logger.info("Watching '%s'. Run 'p4clean --query' in this folder to see what would be deleted." % root)
+        try:
+            watcher.serve()
+        except OSError, e:
+            logger.error("Cannot watch '%s' (%s)" % (root, e))
+        except KeyboardInterrupt:
+            pass
+
+    def query(self, root):
+        """ Log what a clean of root would delete, as known by its watch
+        service."""
+        if not hasattr(socket, 'AF_UNIX'):
+            # e.g.: on Windows
+            logger.error("Cannot query '%s' (the watch service is only available on Linux)" % root)
+            return
+        try:
+            entries = query_watcher(root)
+        except socket.error, e:
+            if e.errno == errno.EPERM:
+                logger.error("Cannot query the p4clean watch service of '%s' (%s)" % (root, e.strerror))
+            else:
+                logger.error("No p4clean watch service answers for '%s'. Start one with 'p4clean --watch'." % root)
+            return
+        except ShellExecuteException:
+            return
+        files_count = 0
+        folders_count = 0
+        for entry in entries:
+            if entry.is_dir:
+                folders_count = folders_count + 1
+                logger.info("Would delete folder: '%s' " % entry.path)
+            else:
+                files_count = files_count + 1
+                logger.info("Would delete file: '%s' " % entry.path)
+        logger.info(80 * "-")
+        logger.info("%d untracked files would be deleted." % files_count)
+        logger.info("%d empty folders would be deleted." % folders_count)
+
     def delete_empty_folders(self):
         """Delete all empty folders under root (excluding root)"""
-        empty_deleted_count = 0
-        error_msgs = []
         root = os.getcwd()
-        for path, directories, files in os.walk(root, topdown=False):
-            if not files and path is not root:
-                absolute_path = os.path.abspath(path)
-                if not self.config.is_excluded(absolute_path):
-                    if not os.listdir(absolute_path):
-                        if self.dry_run:
-                            logger.info("Would delete folder: '%s' " % absolute_path)
-                            empty_deleted_count = empty_deleted_count + 1
-                            continue
-                        try:
-                            os.rmdir(absolute_path)
-                            logger.info("Deleted folder: '%s' " % absolute_path)
-                            empty_deleted_count = empty_deleted_count + 1
-                        except:
-                            error_msgs.append("Cannot delete empty folder (%s)" % sys.exc_info()[1])
+        (deleted_files_count, file_error_msgs,
+         empty_deleted_count, error_msgs) = self._clean_listings(root, self._get_listings(root), None)
         return empty_deleted_count, error_msgs
 
     def delete_untracked_files(self):
-        deleted_count = 0
         error_msgs = []
-        for filename in self.perforce.get_untracked_files(os.getcwd()):
-            if not self.config.is_excluded(filename):
-                if self.dry_run:
+        filenames = [filename for filename in self.perforce.get_untracked_files(os.getcwd())
+                     if not self.config.is_excluded(filename)]
+        deleted_count = self._delete_files(filenames, error_msgs).count(True)
+        return deleted_count, error_msgs
+
+    def _get_listings(self, root, snapshot=None):
+        """ Return the (directories, files) listing of every folder under
+        root, by folder path. Folders unchanged since the `snapshot` are not
+        listed again. Excluded folders trees are not listed."""
+        listings = {}
+        excluded = None
+        if self.config:
+            excluded = self.config.is_excluded
+        with stats.phase('walk'):
+            for path, directories, files in scan_tree(root, self.jobs, snapshot, excluded):
+                listings[path] = (directories, files)
+        return listings
+
+    def _load_snapshot(self, root):
+        """ Return the folder tree snapshot saved in root. Return None if
+        there is none."""
+        try:
+            (version, snapshot_root, snapshot) = load_marshal_file(
+                os.path.join(root, SNAPSHOT_FILENAME))
+        except (TypeError, ValueError):
+            return None
+        if version != P4Clean.SNAPSHOT_VERSION or snapshot_root != root:
+            return None
+        return snapshot
+
+    def _save_snapshot(self, root, walk_time, listings):
+        """ Save in root the folder `listings` with the folders modification
+        time. Folders changed since the walk started are left out: their
+        listing may be outdated."""
+        snapshot = {}
+        for path, (directories, files) in listings.iteritems():
+            try:
+                mtime = os.lstat(path).st_mtime
+            except OSError:
+                continue
+            if mtime < walk_time - P4Clean.MTIME_RESOLUTION:
+                snapshot[path] = (mtime, directories, files)
+        snapshot_path = os.path.join(root, SNAPSHOT_FILENAME)
+        if not save_marshal_file(snapshot_path, (P4Clean.SNAPSHOT_VERSION, root, snapshot)):
+            logger.error("Cannot save the folder tree snapshot at '%s'" % snapshot_path)
+
+    def _clean_listings(self, root, listings, tracked_files, changed_folders=None):
+        """ Delete untracked files and empty folders from the folder
+        `listings` of root. Files are deleted first. Then folders are visited
+        bottom-up: a folder is empty once its files were deleted and its sub
+        folders were removed, so no folder is listed again. If
+        `tracked_files` is None, no file is deleted. If `changed_folders` is
+        given (normalized paths), only these folders and the folders emptied
+        by the clean are deleted when empty. `listings` is left with the
+        remaining entries."""
+        file_error_msgs = []
+        deleted_folders_count = 0
+        folder_error_msgs = []
+        # Sub folders sort after their parent: reverse order is bottom-up.
+        bottom_up_paths = sorted(listings, reverse=True)
+        with stats.phase('diff'):
+            (untracked_files, untracked_trees, untracked_tree_files) = \
+                self._find_untracked(root, listings, tracked_files, bottom_up_paths)
+        # Untracked files are deleted first, all together. Files of untracked
+        # trees are not logged one by one.
+        deleted_files = self._delete_files([filename for path, file, filename in untracked_files],
+                                           file_error_msgs)
+        deleted_tree_files = self._delete_files([filename for path, file, filename in untracked_tree_files],
+                                                file_error_msgs, log=False)
+        deleted_files_count = deleted_files.count(True) + deleted_tree_files.count(True)
+        # Deleted files and folders names by folder path.
+        deleted_names = {}
+        for (path, file, filename), deleted in zip(untracked_files + untracked_tree_files,
+                                                   deleted_files + deleted_tree_files):
+            if deleted:
+                deleted_names.setdefault(path, set()).add(file)
+        folder_remover = FolderRemover()
+        try:
+            with stats.phase('rmdir'):
+                for path, directories, files, reason in self._plan_folders(root, listings, untracked_trees,
+                                                                            deleted_names, changed_folders,
+                                                                            bottom_up_paths):
+                    # All the sub folders were visited.
+                    folder_remover.release(path)
+                    listings[path] = (directories, files)
+                    if reason == UntrackedEntry.UNTRACKED_TREE:
+                        deleted = self._delete_folder(path, folder_error_msgs, False, folder_remover)
+                        if deleted and os.path.dirname(path) not in untracked_trees:
+                            self._log_deleted_tree(path)
+                    elif reason == UntrackedEntry.EMPTY_FOLDER:
+                        deleted = self._delete_folder(path, folder_error_msgs, True, folder_remover)
+                    else:
+                        deleted = False
+                    if deleted:
+                        del listings[path]
+                        deleted_folders_count = deleted_folders_count + 1
+                        parent, name = os.path.split(path)
+                        deleted_names.setdefault(parent, set()).add(name)
+        finally:
+            folder_remover.close()
+        return (deleted_files_count, file_error_msgs,
+                deleted_folders_count, folder_error_msgs)
+
+    def _plan_folders(self, root, listings, untracked_trees, deleted_names,
+                      changed_folders=None, bottom_up_paths=None):
+        """ Visit the folder `listings` of root bottom-up and yield, for each
+        folder, its remaining directories and files and the reason to delete
+        it: `UntrackedEntry.UNTRACKED_TREE`, `UntrackedEntry.EMPTY_FOLDER` or
+        None to keep it.
+
+        Emptiness goes up from the listings: folders are never listed again
+        and folders left untouched cost no work. A folder is empty once the
+        names deleted in it are left out of its listing. `deleted_names` are
+        the sets of deleted names by folder path: the caller adds the name of
+        each folder it deletes before the next folder is visited. Visited
+        folders are popped from it; `listings` is left unchanged. If
+        `changed_folders` is given (normalized paths), only these folders
+        and the folders emptied by the clean are deleted when empty.
+        """
+        if bottom_up_paths is None:
+            # Sub folders sort after their parent: reverse order is bottom-up.
+            bottom_up_paths = sorted(listings, reverse=True)
+        for path in bottom_up_paths:
+            directories, files = listings[path]
+            names = deleted_names.pop(path, None)
+            if names is not None:
+                directories = [directory for directory in directories if directory not in names]
+                files = [file for file in files if file not in names]
+            is_empty = not files and not directories and path != root and \
+                (changed_folders is None or names is not None or
+                 os.path.normcase(path) in changed_folders)
+            reason = None
+            if is_empty and path in untracked_trees:
+                reason = UntrackedEntry.UNTRACKED_TREE
+            elif is_empty and not self.config.is_excluded(path):
+                reason = UntrackedEntry.EMPTY_FOLDER
+            yield path, directories, files, reason
+
+    def _find_untracked(self, root, listings, tracked_files, bottom_up_paths=None):
+        """ Return the untracked files, the untracked trees and the files of
+        these trees in the folder `listings` of root. Excluded files are left
+        out. An untracked tree is a folder under root with no tracked or
+        excluded entry in its whole tree: it can be deleted as a whole.
+
+        Files are (path, file, normalized filename) tuples. `tracked_files` is
+        a `TrackedIndex`. If None, nothing is untracked. `bottom_up_paths` are
+        the listings paths in reverse order, if already sorted.
+        """
+        untracked_files = []
+        untracked_trees = set()
+        untracked_tree_files = []
+        if tracked_files is None:
+            return untracked_files, untracked_trees, untracked_tree_files
+        if bottom_up_paths is None:
+            # Sub folders sort after their parent: reverse order is bottom-up.
+            bottom_up_paths = sorted(listings, reverse=True)
+        for path in bottom_up_paths:
+            directories, files = listings[path]
+            folder = os.path.normcase(path)
+            has_tracked_files = tracked_files.has_tracked_files(folder)
+            tracked_names = tracked_files.tracked_names(folder)
+            is_untracked_tree = not has_tracked_files and path != root and \
+                not self.config.is_excluded(path)
+            folder_untracked_files = []
+            for file in files:
+                if has_tracked_files and os.path.normcase(file) in tracked_names:
+                    continue
+                filename = os.path.normcase(os.path.join(path, file))
+                if self.config.is_excluded(filename):
+                    is_untracked_tree = False
+                    continue
+                folder_untracked_files.append((path, file, filename))
+            if is_untracked_tree:
+                for directory in directories:
+                    if os.path.join(path, directory) not in untracked_trees:
+                        is_untracked_tree = False
+                        break
+            if is_untracked_tree:
+                untracked_trees.add(path)
+                untracked_tree_files.extend(folder_untracked_files)
+            else:
+                untracked_files.extend(folder_untracked_files)
+        untracked_files.sort()
+        return untracked_files, untracked_trees, untracked_tree_files
+
+    def _log_deleted_tree(self, path):
+        if self.dry_run:
+            logger.info("Would delete folder tree: '%s' " % path)
+        else:
+            logger.info("Deleted folder tree: '%s' " % path)
+
+    def _delete_folder(self, path, error_msgs, log=True, folder_remover=None):
+        """ Delete an empty folder. Return True if deleted."""
+        if self.dry_run:
+            if log:
+                logger.info("Would delete folder: '%s' " % path)
+            return True
+        if folder_remover:
+            error = folder_remover.remove(path)
+        else:
+            error = _remove_folder(path)
+        if error:
+            error_msgs.append("Cannot delete empty folder (%s)" % error)
+            return False
+        if log:
+            logger.info("Deleted folder: '%s' " % path)
+        return True
+
+    def _delete_files(self, filenames, error_msgs, log=True):
+        """ Delete files with a pool of `jobs` threads. Results are logged in
+        the `filenames` order. Return a list telling which file was
+        deleted."""
+        if self.dry_run:
+            if log:
+                for filename in filenames:
                     logger.info("Would delete file: '%s' " % filename)
-                    deleted_count = deleted_count + 1
+            return [True] * len(filenames)
+        errors = remove_files(filenames, self.jobs)
+        deleted = []
+        for filename, error in zip(filenames, errors):
+            if error:
+                error_msgs.append("Cannot delete file (%s)" % error)
+                deleted.append(False)
+            else:
+                if log:
+                    logger.info("Deleted file: '%s'" % filename)
+                deleted.append(True)
+        return deleted
+
+
+class Watcher(object):
+
+    """ Watch service keeping the folder tree of root and the files tracked
+    by Perforce in memory, to answer what a clean of root would delete in
+    milliseconds.
+
+    The folder tree is updated from inotify events. Perforce is checked every
+    `interval` seconds: the have list is queried again only if the client
+    was synced, the opened files every time. Queries are answered over the
+    unix socket at 'socket_path' (see `query_watcher`).
+    """
+
+    def __init__(self, cleaner, root, socket_path, interval=DEFAULT_WATCH_INTERVAL):
+        self.cleaner = cleaner
+        self.root = root
+        self.socket_path = socket_path
+        self.interval = interval
+        self.listings = {}
+        self.have_key = None
+        self.have_files = None
+        self.tracked_files = None
+        # Answer to queries until something changes.
+        self.answer = None
+        # Set if folders could not be watched: the tree is listed again on
+        # each query.
+        self.rescan = False
+        self.inotify = None
+        (self._stop_read, self._stop_write) = os.pipe()
+
+    def serve(self):
+        """ Answer queries until `stop` is called. Raise `OSError` if inotify
+        is not available, if the socket folder is not private or if a service
+        already answers on the socket."""
+        self.inotify = Inotify()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bound = False
+        try:
+            _make_private_folder(os.path.dirname(self.socket_path))
+            if os.path.lexists(self.socket_path):
+                if _is_answering(self.socket_path):
+                    raise OSError(errno.EADDRINUSE, "A watch service is already running",
+                                  self.socket_path)
+                # Left by a service that was killed.
+                os.remove(self.socket_path)
+            server.bind(self.socket_path)
+            bound = True
+            os.chmod(self.socket_path, stat.S_IRUSR | stat.S_IWUSR)
+            server.listen(8)
+            refresh_task = BackgroundTask(self._refresh_tracked)
+            self._scan(self.root)
+            self._update_tracked(refresh_task.result())
+            refresh_task = None
+            next_refresh = time.time() + self.interval
+            while True:
+                if refresh_task:
+                    timeout = 0.1
+                else:
+                    timeout = max(0, next_refresh - time.time())
+                readable = select.select([self.inotify.fd, server, self._stop_read], [], [], timeout)[0]
+                if self._stop_read in readable:
+                    return
+                if self.inotify.fd in readable:
+                    self._apply_events()
+                if server in readable:
+                    self._answer(server.accept()[0])
+                if refresh_task is None and time.time() >= next_refresh:
+                    refresh_task = BackgroundTask(self._refresh_tracked)
+                elif refresh_task and not refresh_task.is_alive():
+                    self._update_tracked(refresh_task.result())
+                    refresh_task = None
+                    next_refresh = time.time() + self.interval
+        finally:
+            server.close()
+            if bound and os.path.lexists(self.socket_path):
+                os.remove(self.socket_path)
+            self.inotify.close()
+
+    def stop(self):
+        """ Make `serve` return. Can be called from another thread."""
+        os.write(self._stop_write, 'x')
+
+    def _refresh_tracked(self):
+        """ Return the have list key, the have list and the tracked files
+        index. The have list is queried again only if the key changed. Return
+        None if Perforce could not be queried."""
+        perforce = self.cleaner.perforce
+        have_key = perforce._get_have_cache_key(self.root)
+        have_files = self.have_files
+        if have_key is None or have_key != self.have_key or have_files is None:
+            # Synced since the last check
+            have_files = perforce._get_depot_files(self.root, "-Rh")
+            if have_files:
+                have_files.freeze()
+        opened_files = perforce._get_depot_files(self.root, "-Ro")
+        if not have_files or opened_files is None:
+            return None
+        tracked_files = have_files.copy()
+        tracked_files.update(opened_files)
+        return have_key, have_files, tracked_files.freeze()
+
+    def _update_tracked(self, result):
+        if result is None:
+            logger.error("Perforce is unavailable: the tracked files were not updated.")
+            return
+        (self.have_key, self.have_files, self.tracked_files) = result
+        self.answer = None
+
+    def _scan(self, path):
+        """ List and watch the folder tree at 'path'. Return the folders
+        listed."""
+        excluded = self.cleaner.config.is_excluded
+        folders = []
+        for folder, directories, files in scan_tree(path, self.cleaner.jobs, None, excluded):
+            self.listings[folder] = (directories, files)
+            folders.append(folder)
+            try:
+                self.inotify.add(folder)
+            except OSError, e:
+                if not self.rescan:
+                    logger.error("Cannot watch '%s' (%s): the folder tree will be listed again on each query." % (folder, e))
+                self.rescan = True
+        return folders
+
+    def _relist(self, folders):
+        """ List again `folders` watched after they were listed, so entries
+        created in between are not missed."""
+        excluded = self.cleaner.config.is_excluded
+        for folder in folders:
+            directories, files = _list_folder(folder)
+            if directories is None:
+                continue
+            self.listings[folder] = (directories, files)
+            for directory in directories:
+                sub_folder = os.path.join(folder, directory)
+                if sub_folder not in self.listings and not excluded(sub_folder):
+                    self._relist(self._scan(sub_folder))
+
+    def _rescan(self):
+        """ List and watch the whole folder tree again."""
+        self.inotify.remove_tree(self.root)
+        self.listings = {}
+        self.rescan = False
+        self._scan(self.root)
+        self.answer = None
+
+    def _forget(self, path):
+        """ Drop the folder tree at 'path'."""
+        prefix = os.path.join(path, '')
+        for folder in [folder for folder in self.listings
+                       if folder == path or folder.startswith(prefix)]:
+            del self.listings[folder]
+        self.inotify.remove_tree(path)
+
+    def _apply_events(self):
+        """ Update the folder tree from the pending inotify events."""
+        excluded = self.cleaner.config.is_excluded
+        for path, mask, name in self.inotify.read():
+            self.answer = None
+            if path is None:
+                # Events were lost
+                logger.error("Too many changes at once: the folder tree is listed again.")
+                self._rescan()
+                continue
+            if path not in self.listings:
+                continue
+            directories, files = self.listings[path]
+            child = os.path.join(path, name)
+            if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                if not mask & Inotify.IN_ISDIR:
+                    if name not in files:
+                        files.append(name)
                     continue
-                try:
-                    os.remove(filename)
-                except:
-                    if platform.system() == 'Windows':
-                        try:
-                            # Second try on Windows. Maybe the file was read
-                            # only?
-                            os.chmod(filename, stat.S_IWRITE)
-                            os.remove(filename)
-                        except:
-                            error_msgs.append("Cannot delete file (%s)" % sys.exc_info()[1])
-                            continue
-                    else:
-                        error_msgs.append("Cannot delete file (%s)" % sys.exc_info()[1])
-                logger.info("Deleted file: '%s'" % filename)
-                deleted_count = deleted_count + 1
-        return deleted_count, error_msgs
+                if name not in directories:
+                    directories.append(name)
+                if child not in self.listings and not excluded(child):
+                    self._relist(self._scan(child))
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                if not mask & Inotify.IN_ISDIR:
+                    if name in files:
+                        files.remove(name)
+                    continue
+                if name in directories:
+                    directories.remove(name)
+                self._forget(child)
+
+    def _answer(self, connection):
+        """ Send what a clean of root would delete: one
+        'reason<TAB>is_dir<TAB>path' line per entry, or an
+        'error<TAB>0<TAB>message' line."""
+        try:
+            connection.settimeout(10)
+            if not connection.recv(1024):
+                # No query (e.g.: another service checking this one runs).
+                return
+            # Changes made right before the query are not missed.
+            self._apply_events()
+            if self.rescan:
+                self._rescan()
+            if self.answer is None and self.tracked_files is not None:
+                entries = self.cleaner._untracked_entries(self.root, self.listings,
+                                                          self.tracked_files)
+                self.answer = "".join(["%s\t%d\t%s\n" % (entry.reason, entry.is_dir, entry.path)
+                                       for entry in entries])
+            if self.answer is None:
+                connection.sendall("error\t0\tPerforce is unavailable\n")
+            else:
+                connection.sendall(self.answer)
+        except socket.error, e:
+            logger.error("Cannot answer a query (%s)" % e)
+        finally:
+            connection.close()
+
+
+def remove_nested_paths(paths):
+    """ Return the sorted `paths` without duplicates and without the paths
+    inside another one."""
+    kept = []
+    for path in sorted(set([os.path.normpath(path) for path in paths])):
+        # Parents sort before their sub folders.
+        if not [parent for parent in kept if path.startswith(os.path.join(parent, ''))]:
+            kept.append(path)
+    return kept
+
+
+def parse_newer_than(value):
+    """ Return the time in seconds since epoch given by the `--newer-than`
+    option 'value': the modification time of a file, seconds since epoch or
+    a local date and time (YYYY-MM-DD[ HH:MM[:SS]])."""
+    if os.path.exists(value):
+        return os.stat(value).st_mtime
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, time_format))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("'%s' is neither a file nor a time" % value)
+
+
+def watch_socket_path(root):
+    """ Return the path of the unix socket of the watch service of
+    'root', in a temporary folder of the current user only."""
+    digest = hashlib.md5(os.path.normcase(os.path.abspath(root))).hexdigest()
+    folder = os.path.join(tempfile.gettempdir(), 'p4clean-%d' % os.getuid())
+    return os.path.join(folder, '%s.sock' % digest[:16])
+
+
+def _make_private_folder(folder):
+    """ Create 'folder', accessible by the current user only, if missing.
+    Raise `OSError` if it is not such a folder."""
+    try:
+        os.mkdir(folder, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    _check_private_folder(folder)
+
+
+def _check_private_folder(folder):
+    """ Raise `OSError` unless 'folder' is a folder (not a link) owned and
+    accessible by the current user only. Nobody else can then bind a
+    socket in it."""
+    status = os.lstat(folder)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or \
+            stat.S_IMODE(status.st_mode) & 0077:
+        raise OSError(errno.EPERM, "Not a private folder of the current user", folder)
+
+
+def _is_answering(socket_path):
+    """ Return True if a service accepts connections on the unix socket at
+    'socket_path'."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error:
+        return False
+    finally:
+        connection.close()
+    return True
+
+
+def _peer_uid(connection, socket_path):
+    """ Return the user id of the service answering on the unix socket
+    `connection`: of the process itself on Linux, of the socket file
+    owner elsewhere."""
+    if sys.platform.startswith('linux'):
+        credentials = connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                            struct.calcsize('3i'))
+        # pid, uid, gid
+        return struct.unpack('3i', credentials)[1]
+    return os.lstat(socket_path).st_uid
+
+
+def query_watcher(root, socket_path=None):
+    """ Ask the watch service of 'root' what a clean would delete
+
+    :root: the folder watched by the service (see `Watcher`)
+    :socket_path: the service unix socket (see `watch_socket_path` by default)
+    :returns: the list of `UntrackedEntry` objects, bottom-up. Raise
+    `socket.error` if no service of the current user answers and
+    `ShellExecuteException` if the service could not query Perforce.
+
+    """
+    if socket_path is None:
+        socket_path = watch_socket_path(root)
+    try:
+        # Another user could not have bound the socket.
+        _check_private_folder(os.path.dirname(socket_path))
+    except OSError, e:
+        raise socket.error(e.errno, "%s: '%s'" % (e.strerror, e.filename))
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        if _peer_uid(connection, socket_path) != os.getuid():
+            raise socket.error(errno.EPERM, "The watch service is not run by the current user")
+        connection.sendall("untracked\n")
+        chunks = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        connection.close()
+    entries = []
+    for line in "".join(chunks).splitlines():
+        reason, is_dir, path = line.split('\t', 2)
+        if reason == 'error':
+            logger.error(path)
+            raise ShellExecuteException
+        entries.append(UntrackedEntry(path, reason, is_dir == '1'))
+    return entries
+
+
+def _clean_shard(arguments):
+    """ Clean a top level folder (a shard) in a worker process of
+    `P4Clean._clean_shards`. `arguments` are the pickled `P4Clean`, the
+    shard path and the logging level. The shard folder itself is not
+    deleted.
+
+    Return the shard path, the `P4Clean.clean` result, whether the shard
+    folder is left empty and the worker stats.
+    """
+    global stats
+    (cleaner, shard, level) = arguments
+    logger.setLevel(level)
+    # Stats of this shard only, even if the worker process was forked.
+    stats = Stats()
+    # The have list cache is for the whole client.
+    cleaner.perforce.use_cache = False
+    if cleaner.perforce.use_reconcile and cleaner.perforce.can_reconcile():
+        tracked_task = BackgroundTask(cleaner.perforce._get_reconciled_files, shard, False)
+    else:
+        tracked_task = BackgroundTask(cleaner.perforce._get_client_files, shard, True, False)
+    listings = cleaner._get_listings(shard)
+    tracked_files = tracked_task.result()
+    result = cleaner._clean_listings(shard, listings, tracked_files)
+    is_empty = listings.get(shard) == ([], [])
+    return shard, result, is_empty, stats.as_dict()
+
+
+def iter_untracked(root, excludes=None, jobs=DEFAULT_JOBS, perforce=None):
+    """ Find what a clean of 'root' would delete, without deleting or
+    logging anything
+
+    :root: the folder to clean, inside the Perforce workspace
+    :excludes: exclusion patterns (list or semicolon separated string), in
+    addition to the '.p4clean' config file ones
+    :jobs: number of folders listed in parallel
+    :perforce: the `Perforce` interface to query (a new one by default)
+    :returns: a generator over `UntrackedEntry` objects, bottom-up: the
+    untracked files of a folder come before the folder itself if it is left
+    empty. Pass them to `delete_untracked` to delete them. Raise
+    `ShellExecuteException` if Perforce cannot be queried and `ValueError` if
+    'root' is outside the workspace.
+
+    """
+    if perforce is None:
+        perforce = Perforce()
+    root = os.path.abspath(root)
+    if not perforce.is_inside_workspace(root):
+        raise ValueError("'%s' is not inside a Perforce workspace" % root)
+    if excludes is not None and not isinstance(excludes, basestring):
+        excludes = ";".join(excludes)
+    cleaner = P4Clean(perforce)
+    cleaner.jobs = jobs
+    cleaner.config = P4CleanConfig(perforce.root, excludes, root)
+    return cleaner.iter_untracked(root)
+
+
+def delete_untracked(entries, jobs=DEFAULT_JOBS):
+    """ Delete the `UntrackedEntry` objects yielded by `iter_untracked`.
+    Files are deleted first with a pool of `jobs` threads, then folders in
+    order. Return (entry, error) tuples for the entries that could not be
+    deleted."""
+    entries = list(entries)
+    files = [entry for entry in entries if not entry.is_dir]
+    failures = []
+    for entry, error in zip(files, remove_files([entry.path for entry in files], jobs)):
+        if error:
+            failures.append((entry, error))
+    folder_remover = FolderRemover()
+    try:
+        with stats.phase('rmdir'):
+            for entry in entries:
+                if entry.is_dir:
+                    error = folder_remover.remove(entry.path)
+                    if error:
+                        failures.append((entry, error))
+    finally:
+        folder_remover.close()
+    return failures
 
 
 def main():
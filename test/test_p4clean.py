@@ -4,14 +4,38 @@ import stat
 import os
 import tempfile
 import platform
+import sys
+import fnmatch
+import json
+import socket
+import time
+import threading
+import p4clean
 from mock import (
     patch,
     Mock,
 )
 from p4clean import (
+    CACHE_FILENAME,
+    SNAPSHOT_FILENAME,
+    BackgroundTask,
+    ExclusionMatcher,
+    FolderRemover,
     P4Clean,
     P4CleanConfig,
     Perforce,
+    ShellExecuteException,
+    Stats,
+    TrackedIndex,
+    TransientShellException,
+    UntrackedEntry,
+    Watcher,
+    delete_untracked,
+    iter_untracked,
+    query_watcher,
+    remove_files,
+    shell_marshal,
+    scan_tree,
 )
 
 
@@ -26,24 +50,24 @@ class P4CleanTests(unittest2.TestCase):
         temp_file.write("")
         temp_file.close()
 
-    @patch('os.walk')
-    def test_perforce_get_untracked_files(self, mock_os_walk):
+    @patch('p4clean.scan_tree')
+    def test_perforce_get_untracked_files(self, mock_scan_tree):
         """ Test Perforce `get_untracked_files` method. """
-        # patch os.walk return value
-        mock_os_walk.return_value = [("/path", ['blarg', 'test'], ['test.log',
+        # patch scan_tree return value
+        mock_scan_tree.return_value = [("/path", ['blarg', 'test'], ['test.log',
                                                                    'newfile.c',
                                                                    'newfile.h'])]
 
         with patch.object(Perforce, 'info') as info_mock:
             # Mock Perforce.info() method
-            info_mock.return_value = (2010, 'dummy')
+            info_mock.return_value = (2010, 'dummy', 'client')
             perforce = Perforce()
             # Mock _get_perforce_fstat
             perforce._get_perforce_fstat = Mock()
-            perforce._get_perforce_fstat.return_value = \
-                "...clientFile /path/test.log \n \
-                ... clientFile /path/blarg/file.txt \n \
-                ... clientFile /path/path2/code.c "
+            perforce._get_perforce_fstat.side_effect = lambda root, option, fields, recursive: {
+                '-Rh': [{'code': 'stat', 'clientFile': "/path/test.log"},
+                        {'code': 'stat', 'clientFile': "/path/blarg/file.txt"}],
+                '-Ro': [{'code': 'stat', 'clientFile': "/path/path2/code.c"}]}[option]
             perforce.is_inside_symbolic_folder = Mock()
             perforce.is_inside_symbolic_folder.return_value = False
 
@@ -54,17 +78,270 @@ class P4CleanTests(unittest2.TestCase):
         self.assertTrue(os.path.normpath("/path/newfile.c") in untracked_files)
         self.assertTrue(os.path.normpath("/path/newfile.h") in untracked_files)
 
-    @patch('os.walk')
+    def test_shell_marshal(self):
+        """ Test `shell_marshal` yields the marshalled objects printed by the
+        command. """
+        script = ("import marshal, sys; "
+                  "marshal.dump({'code': 'stat', 'clientFile': '/path/a b.c'}, sys.stdout); "
+                  "marshal.dump({'code': 'stat', 'clientFile': '/path/d.h'}, sys.stdout)")
+
+        records = list(shell_marshal([sys.executable, "-c", script]))
+
+        self.assertEqual(records, [{'code': 'stat', 'clientFile': '/path/a b.c'},
+                                   {'code': 'stat', 'clientFile': '/path/d.h'}])
+        with self.assertRaises(ShellExecuteException):
+            list(shell_marshal([sys.executable, "-c", "import sys; sys.exit(1)"]))
+
+    def test_shell_marshal_timeout(self):
+        """ Test `shell_marshal` stops a command printing nothing for
+        `timeout` seconds. """
+        script = ("import marshal, sys, time; "
+                  "marshal.dump({'code': 'stat'}, sys.stdout); sys.stdout.flush(); "
+                  "time.sleep(10)")
+
+        start = time.time()
+        records = []
+        with self.assertRaises(TransientShellException):
+            for record in shell_marshal([sys.executable, "-c", script], timeout=0.5):
+                records.append(record)
+        self.assertEqual(records, [{'code': 'stat'}])
+        self.assertLess(time.time() - start, 5)
+
+    def test_shell_marshal_timeout_joins_watchdog(self):
+        """ Test `shell_marshal` leaves no watchdog thread running once the
+        command is done. """
+        script = "import marshal, sys; marshal.dump({'code': 'stat'}, sys.stdout)"
+
+        for index in xrange(5):
+            records = list(shell_marshal([sys.executable, "-c", script], timeout=10))
+
+            self.assertEqual(records, [{'code': 'stat'}])
+            self.assertEqual([thread for thread in threading.enumerate()
+                              if isinstance(thread, p4clean._Watchdog)], [])
+
+    def test_shell_marshal_timeout_mid_record(self):
+        """ Test `shell_marshal` stops a command printing nothing for
+        `timeout` seconds in the middle of a record. """
+        script = ("import marshal, sys, time; "
+                  "data = marshal.dumps({'code': 'stat'}, 0); "
+                  "sys.stdout.write(data + data[:7]); sys.stdout.flush(); "
+                  "time.sleep(10)")
+
+        start = time.time()
+        records = []
+        with self.assertRaises(TransientShellException):
+            for record in shell_marshal([sys.executable, "-c", script], timeout=0.5):
+                records.append(record)
+        self.assertEqual(records, [{'code': 'stat'}])
+        self.assertLess(time.time() - start, 5)
+
+    @patch('time.sleep')
+    @patch('p4clean.shell_marshal')
+    def test_perforce_retries(self, mock_shell_marshal, mock_sleep):
+        """ Test Perforce commands failing on a timeout or a lost connection
+        are run again, and other errors are not. """
+        def timed_out(command, timeout=None):
+            yield {'code': 'stat', 'clientFile': '/path/a.c'}
+            raise TransientShellException
+        lost_connection = [{'code': 'error', 'severity': 4, 'generic': Perforce.EV_COMM,
+                            'data': 'Connect to server failed; check $P4PORT.'}]
+        answer = [{'code': 'stat', 'clientFile': '/path/a.c'}]
+        mock_shell_marshal.side_effect = [timed_out(None), iter(lost_connection), iter(answer)]
+        with patch.object(Perforce, 'info') as info_mock:
+            info_mock.return_value = (2010, 'dummy', 'client')
+            perforce = Perforce()
+        perforce.timeout = 10
+        perforce.retries = 2
+
+        records = perforce._get_records(["p4", "-G", "fstat", "/path/..."])
+
+        # Records streamed before the failure come again.
+        self.assertEqual(records, [answer[0], answer[0]])
+        self.assertEqual(mock_shell_marshal.call_args[1], {'timeout': 10})
+        self.assertEqual([call[0][0] for call in mock_sleep.call_args_list],
+                         [Perforce.RETRY_DELAY, 2 * Perforce.RETRY_DELAY])
+
+        # Out of retries
+        mock_shell_marshal.side_effect = [iter(lost_connection), iter(lost_connection)]
+        perforce.retries = 1
+        with self.assertRaises(TransientShellException):
+            perforce._get_records(["p4", "-G", "fstat", "/path/..."])
+
+        # Not a communication error
+        mock_shell_marshal.side_effect = None
+        mock_shell_marshal.return_value = [{'code': 'error', 'severity': 3, 'generic': 6,
+                                            'data': 'access denied.'}]
+        mock_shell_marshal.reset_mock()
+        with self.assertRaises(ShellExecuteException):
+            perforce._get_records(["p4", "-G", "fstat", "/path/..."])
+        self.assertEqual(mock_shell_marshal.call_count, 1)
+
+    @patch('p4clean.shell_marshal')
+    def test_perforce_fstat_records(self, mock_shell_marshal):
+        """ Test Perforce `_get_perforce_fstat` keeps file records, skips
+        warnings and fails on errors. """
+        mock_shell_marshal.return_value = [
+            {'code': 'stat', 'clientFile': '/path/a.c', 'headAction': 'edit'},
+            {'code': 'error', 'severity': 2, 'data': 'no such file(s).'},
+        ]
+        with patch.object(Perforce, 'info') as info_mock:
+            info_mock.return_value = (2010, 'dummy', 'client')
+            perforce = Perforce()
+
+            records = list(perforce._get_perforce_fstat("/path", "-Rh"))
+            self.assertEqual(records, [{'code': 'stat', 'clientFile': '/path/a.c',
+                                        'headAction': 'edit'}])
+
+            mock_shell_marshal.return_value = [
+                {'code': 'error', 'severity': 3, 'data': 'access denied.'}]
+            with self.assertRaises(ShellExecuteException):
+                list(perforce._get_perforce_fstat("/path", "-Rh"))
+
+    @patch('p4clean.shell_marshal')
+    def test_perforce_info(self, mock_shell_marshal):
+        """ Test Perforce `info` reads the marshalled `p4 info` and the
+        workspace check needs no other query. """
+        root_folder = tempfile.mkdtemp()
+        mock_shell_marshal.return_value = [
+            {'code': 'stat', 'clientName': 'Client', 'clientRoot': root_folder,
+             'serverVersion': 'P4D/LINUX26X86_64/2013.1/610569 (2013/03/19)'}]
+
+        self.assertEqual(Perforce.info(), (2013, root_folder, 'Client'))
+        perforce = Perforce()
+        self.assertEqual(mock_shell_marshal.call_count, 2)
+
+        self.assertTrue(perforce.is_inside_workspace(root_folder))
+        self.assertTrue(perforce.is_inside_workspace(os.path.join(root_folder, 'folder')))
+        self.assertFalse(perforce.is_inside_workspace(root_folder + 'folder'))
+        self.assertFalse(perforce.is_inside_workspace(os.path.dirname(root_folder)))
+        self.assertEqual(mock_shell_marshal.call_count, 2)
+        shutil.rmtree(root_folder)
+
+        # Unknown client
+        mock_shell_marshal.return_value = [
+            {'code': 'stat', 'clientName': '*unknown*',
+             'serverVersion': 'P4D/LINUX26X86_64/2013.1/610569 (2013/03/19)'}]
+        self.assertFalse(Perforce().is_inside_workspace(root_folder))
+
+    def test_perforce_have_cache(self):
+        """ Test Perforce reuses the saved have list only when the cache key
+        did not change. """
+        root_folder = tempfile.mkdtemp()
+        with patch.object(Perforce, 'info') as info_mock:
+            info_mock.return_value = (2010, root_folder, 'client')
+            perforce = Perforce()
+        perforce.use_cache = True
+        have_files = set([os.path.normcase(os.path.join(root_folder, 'a.c')),
+                          os.path.normcase(os.path.join(root_folder, 'folder', 'b.h'))])
+        perforce._get_depot_files = Mock()
+        perforce._get_depot_files.return_value = TrackedIndex(have_files)
+        perforce._get_have_cache_key = Mock()
+        perforce._get_have_cache_key.return_value = ('client', 42, 2, 100)
+
+        # First call fills the cache
+        self.assertEqual(set(perforce._get_cached_have_files(root_folder)), have_files)
+        self.assertEqual(perforce._get_depot_files.call_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(root_folder, CACHE_FILENAME)))
+
+        # Same key: the have list is not queried again
+        self.assertEqual(set(perforce._get_cached_have_files(root_folder)), have_files)
+        self.assertEqual(perforce._get_depot_files.call_count, 1)
+
+        # The client was synced: the have list is queried again
+        perforce._get_have_cache_key.return_value = ('client', 43, 2, 100)
+        self.assertEqual(set(perforce._get_cached_have_files(root_folder)), have_files)
+        self.assertEqual(perforce._get_depot_files.call_count, 2)
+
+        shutil.rmtree(root_folder)
+
+    @patch('p4clean.shell_marshal')
+    def test_perforce_have_cache_key(self, mock_shell_marshal):
+        """ Test the have list cache key changes with the synced files size
+        when the highest changelist and the files count do not (e.g.: a file
+        removed and another one synced at an older changelist). """
+        sizes = {'fileCount': '2', 'fileSize': '100'}
+
+        def marshal(command, timeout=None):
+            if command[2] == 'changes':
+                return [{'code': 'stat', 'change': '42'}]
+            record = {'code': 'stat'}
+            record.update(sizes)
+            return [record]
+        mock_shell_marshal.side_effect = marshal
+        with patch.object(Perforce, 'info') as info_mock:
+            info_mock.return_value = (2010, 'dummy', 'client')
+            perforce = Perforce()
+
+        key = perforce._get_have_cache_key('/path')
+        self.assertEqual(key, ('client', 42, 2, 100))
+        sizes['fileSize'] = '120'
+        self.assertNotEqual(perforce._get_have_cache_key('/path'), key)
+
+    def test_tracked_index(self):
+        """ Test `TrackedIndex` answers per folder and knows folder trees
+        without tracked files. """
+        index = TrackedIndex([os.path.normpath('/path/a.c'),
+                              os.path.normpath('/path/folder/sub/b.h'),
+                              os.path.normpath('/path/folder/sub/b.h')])
+
+        self.assertEqual(len(index), 2)
+        self.assertTrue(os.path.normpath('/path/folder/sub/b.h') in index)
+        self.assertFalse(os.path.normpath('/path/folder/b.h') in index)
+        self.assertEqual(set(index.tracked_names(os.path.normpath('/path/folder/sub'))), set(['b.h']))
+        self.assertTrue(index.has_tracked_files(os.path.normpath('/path/folder')))
+        self.assertFalse(index.has_tracked_files(os.path.normpath('/path/build')))
+        self.assertEqual(sorted(index), [os.path.normpath('/path/a.c'),
+                                         os.path.normpath('/path/folder/sub/b.h')])
+
+        # Files added to a frozen index
+        index.add(os.path.normpath('/path/folder/c.h'))
+        index.add(os.path.normpath('/path/folder/sub/a.h'))
+        index.freeze()
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.tracked_names(os.path.normpath('/path/folder/sub')), set(['a.h', 'b.h']))
+        self.assertTrue(os.path.normpath('/path/folder/c.h') in index)
+        self.assertFalse(os.path.normpath('/path/folder/b.h') in index)
+
+    def test_background_task(self):
+        """ Test `BackgroundTask` gives back the function result or raises
+        its exception. """
+        def fail():
+            raise ShellExecuteException
+
+        self.assertEqual(BackgroundTask(max, 1, 2).result(), 2)
+        with self.assertRaises(ShellExecuteException):
+            BackgroundTask(fail).result()
+
+    @patch('p4clean.scan_tree')
+    def test_perforce_get_untracked_files_fstat_error(self, mock_scan_tree):
+        """ Test Perforce `get_untracked_files` returns nothing when the fstat
+        stream fails midway. """
+        mock_scan_tree.return_value = [("/path", [], ['newfile.c'])]
+
+        def failing_fstat(root, option, fields, recursive=True):
+            yield {'code': 'stat', 'clientFile': "/path/test.log"}
+            raise ShellExecuteException
+
+        with patch.object(Perforce, 'info') as info_mock:
+            info_mock.return_value = (2010, 'dummy', 'client')
+            perforce = Perforce()
+            perforce._get_perforce_fstat = failing_fstat
+
+            untracked_files = perforce.get_untracked_files("dummy")
+
+        self.assertEqual(untracked_files, [])
+
+    @patch('p4clean.scan_tree')
     def test_get_untracked_files_with_same_filename_different_case(self,
-                                                                   mock_os_walk):
+                                                                   mock_scan_tree):
         """ Test P4Clean differentiates untracked files with same filename but
         different case."""
         # This test cannot be ran under windows. System is case insensitive.
         if platform.system() == 'Windows':
             return
 
-        # patch os.walk return value
-        mock_os_walk.return_value = [("/path", [], ['test.log',
+        # patch scan_tree return value
+        mock_scan_tree.return_value = [("/path", [], ['test.log',
                                                     'TEST.log',
                                                     'readme.txt',
                                                     'README.txt',
@@ -72,15 +349,15 @@ class P4CleanTests(unittest2.TestCase):
 
         with patch.object(Perforce, 'info') as info_mock:
             # Mock Perforce.info() method
-            info_mock.return_value = (2010, 'dummy')
+            info_mock.return_value = (2010, 'dummy', 'client')
 
             perforce = Perforce()
             # Mock _get_perforce_fstat
             perforce._get_perforce_fstat = Mock()
-            perforce._get_perforce_fstat.return_value = \
-                "... clientFile /path/readme.txt \n \
-                ... clientFile /path/README.txt \n \
-                ... clientFile /path/path2/code.c "
+            perforce._get_perforce_fstat.return_value = [
+                {'code': 'stat', 'clientFile': "/path/readme.txt"},
+                {'code': 'stat', 'clientFile': "/path/README.txt"},
+                {'code': 'stat', 'clientFile': "/path/path2/code.c"}]
             perforce.is_inside_symbolic_folder = Mock()
             perforce.is_inside_symbolic_folder.return_value = False
 
@@ -150,6 +427,88 @@ class P4CleanTests(unittest2.TestCase):
         self.assertFalse(config.is_excluded("/blarg"))
         self.assertFalse(config.is_excluded("/blarg/blarg/blarg"))
 
+    def test_hierarchical_config_files(self):
+        """ Test P4CleanConfig applies the .p4clean files of the parent
+        folders and of each sub folder to its tree. """
+        root_folder = tempfile.mkdtemp()
+        os.makedirs(root_folder + '/folderA/folderAA')
+        os.makedirs(root_folder + '/folderB')
+        config_file = open(root_folder + '/.p4clean', 'w')
+        config_file.write("[p4clean]\nexclude = *.log\n")
+        config_file.close()
+        config_file = open(root_folder + '/folderA/.p4clean', 'w')
+        config_file.write("[p4clean]\nexclude = *.tmp\n")
+        config_file.close()
+
+        config = P4CleanConfig(root_folder, None, root_folder)
+        self.assertTrue(config.is_excluded(root_folder + '/folderA/file.tmp'))
+        self.assertTrue(config.is_excluded(root_folder + '/folderA/folderAA/file.tmp'))
+        self.assertTrue(config.is_excluded(root_folder + '/folderA/folderAA/file.log'))
+        self.assertTrue(config.is_excluded(root_folder + '/folderB/file.log'))
+        self.assertFalse(config.is_excluded(root_folder + '/folderB/file.tmp'))
+        self.assertFalse(config.is_excluded(root_folder + '/file.tmp'))
+        # Folders without a .p4clean file share their parent matcher.
+        self.assertIs(config._folder_matcher(root_folder + '/folderB'),
+                      config._folder_matcher(root_folder))
+        self.assertIs(config._folder_matcher(root_folder + '/folderA/folderAA'),
+                      config._folder_matcher(root_folder + '/folderA'))
+
+        # Normalized paths (e.g.: lower case on Windows) get the same
+        # matchers. Here, paths are normalized to another path to the same
+        # folder.
+        link_folder = os.path.join(os.path.dirname(root_folder),
+                                   'link_' + os.path.basename(root_folder))
+        os.symlink(root_folder, link_folder)
+        with patch('os.path.normcase', lambda path: path.replace(root_folder, link_folder)):
+            config = P4CleanConfig(root_folder, None, root_folder)
+            filename = root_folder + '/folderA/folderAA/file.tmp'
+            self.assertTrue(config.is_excluded(filename))
+            self.assertTrue(config.is_excluded(os.path.normcase(filename)))
+        os.remove(link_folder)
+
+        # From a sub folder, the .p4clean files above apply too.
+        config = P4CleanConfig(root_folder, None, root_folder + '/folderA/folderAA')
+        self.assertTrue(config.is_excluded(root_folder + '/folderA/folderAA/file.tmp'))
+        self.assertTrue(config.is_excluded(root_folder + '/folderA/folderAA/file.log'))
+        shutil.rmtree(root_folder)
+
+    @patch('p4clean.logger')
+    def test_malformed_nested_config_file(self, mock_logger):
+        """ Test P4CleanConfig ignores a nested .p4clean file without section
+        header, also when parsed by the folder listing threads. """
+        root_folder = os.path.realpath(tempfile.mkdtemp())
+        os.makedirs(root_folder + '/folderA/folderAA')
+        config_file = open(root_folder + '/folderA/.p4clean', 'w')
+        config_file.write("exclude = *.log\n")
+        config_file.close()
+
+        instance = P4Clean(Mock())
+        instance.config = P4CleanConfig(root_folder, None, root_folder)
+        listings = instance._get_listings(root_folder)
+
+        self.assertEqual(sorted(listings), [root_folder, root_folder + '/folderA',
+                                            root_folder + '/folderA/folderAA'])
+        self.assertFalse(instance.config.is_excluded(root_folder + '/folderA/file.log'))
+        self.assertEqual(mock_logger.error.call_count, 1)
+        shutil.rmtree(root_folder)
+
+    def test_exclusion_matcher(self):
+        """ Test `ExclusionMatcher` matches like `fnmatch` whatever the
+        pattern shape. """
+        patterns = ['tags', '*.log', '*.tar.gz', '*/.p4clean', '/folder/build*',
+                    '*/.git*', '*', 'a*b', '*.[ch]', 'file?.txt', '', '*.']
+        paths = ['tags', '/tags', 'a.log', '/folder/a.log', '/folder.log/a',
+                 '/a.tar.gz', '/a.gz', '/x/.p4clean', '.p4clean', '/folder/build',
+                 '/folder/build/obj/a.o', '/folder/.git', '/folder/.gitignore',
+                 '/folder/git', 'ab', 'a/b', 'acb', '/src/a.c', '/src/a.cpp',
+                 'file1.txt', 'file12.txt', '', '/a.', '/.log']
+        for pattern in patterns:
+            matcher = ExclusionMatcher([pattern])
+            for path in paths:
+                self.assertEqual(matcher.match(path), fnmatch.fnmatchcase(path, pattern),
+                                 "pattern '%s' on path '%s'" % (pattern, path))
+        self.assertFalse(ExclusionMatcher([]).match('/a'))
+
     def test_config_file_path_empty(self):
         """ Test P4CleanConfig._config_file_path method returns `None` if no
         root is provided."""
@@ -159,6 +518,47 @@ class P4CleanTests(unittest2.TestCase):
 
         self.assertIsNone(path)
 
+    def test_scan_tree(self):
+        """ Test `scan_tree` lists every folder once and lists symbolic links
+        to folders as files. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/folderA')
+        os.mkdir(root_folder + '/folderA/folderAA')
+        os.mkdir(root_folder + '/folderB')
+        self._create_file(root_folder, 'folderA/temp.txt')
+        self._create_file(root_folder, 'folderA/folderAA/temp.txt')
+        if platform.system() != 'Windows':
+            os.symlink(root_folder + '/folderA', root_folder + '/folderB/link')
+
+        listings = dict((path, (sorted(directories), sorted(files)))
+                        for path, directories, files in scan_tree(root_folder, jobs=3))
+
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(len(listings), 4)
+        self.assertEqual(listings[root_folder], (['folderA', 'folderB'], []))
+        self.assertEqual(listings[os.path.join(root_folder, 'folderA')],
+                         (['folderAA'], ['temp.txt']))
+        self.assertEqual(listings[os.path.join(root_folder, 'folderA', 'folderAA')],
+                         ([], ['temp.txt']))
+        if platform.system() != 'Windows':
+            self.assertEqual(listings[os.path.join(root_folder, 'folderB')],
+                             ([], ['link']))
+
+    def test_scan_tree_error(self):
+        """ Test `scan_tree` raises again an error of a listing thread
+        instead of waiting for the listing forever. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/folderA')
+
+        def excluded(path):
+            raise KeyError(path)
+
+        with self.assertRaises(KeyError):
+            list(scan_tree(root_folder, jobs=2, excluded=excluded))
+
+        shutil.rmtree(root_folder)
+
     @patch('p4clean.Perforce')
     def test_delete_empty_folders(self, mock_perforce):
         """ Test P4Clean 'delete empty folders' feature. """
@@ -185,11 +585,24 @@ class P4CleanTests(unittest2.TestCase):
         self._create_file(root_folder, 'folderA/folderAA/temp.txt')
         self._create_file(root_folder, 'folderD/folderDD/temp.txt')
 
+        # All files are tracked
+        instance.get_tracked_files.return_value = TrackedIndex(
+            os.path.normcase(os.path.join(os.getcwd(), path))
+            for path in ['folderA/temp.txt', 'folderA/folderAA/temp.txt',
+                         'folderD/folderDD/temp.txt'])
+
         with patch('argparse.ArgumentParser.parse_args') as mock_parse_args:
-            # patched method `parse_args` to return `quiet` and `dry_run` as
-            # False and `exclude` as `None`
+            # patched method `parse_args` to return `quiet`, `dry_run`,
+            # `cache`, `incremental`, `reconcile` and `stats` as False and
+            # `exclude`, `newer_than` and `stats_json` as `None`
             mock_parse_args.return_value = Mock(quiet=False, dry_run=False,
-                                                exclude=None)
+                                                exclude=None, cache=False,
+                                                incremental=False, reconcile=False,
+                                                newer_than=None, jobs=2, processes=1, paths=[],
+                                                timeout=p4clean.DEFAULT_P4_TIMEOUT,
+                                                retries=p4clean.DEFAULT_P4_RETRIES,
+                                                watch=False, query=False,
+                                                stats=False, stats_json=None)
             P4Clean().run()
 
         os.chdir(old_cwd)
@@ -207,6 +620,633 @@ class P4CleanTests(unittest2.TestCase):
 
         shutil.rmtree(root_folder)
 
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_clean(self, mock_p4clean_config, mock_perforce):
+        """ Test P4Clean `clean` method deletes untracked files and the
+        folders they leave empty in a single walk. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/folderA')
+        os.mkdir(root_folder + '/folderA/folderAA')
+        os.mkdir(root_folder + '/folderB')
+        os.mkdir(root_folder + '/folderB/folderBB')
+        self._create_file(root_folder, 'folderA/tracked.txt')
+        self._create_file(root_folder, 'folderA/folderAA/untracked.txt')
+        self._create_file(root_folder, 'folderB/folderBB/untracked.txt')
+
+        # Mock Perforce class to track one file.
+        perforce = mock_perforce.return_value
+        perforce.get_tracked_files.return_value = TrackedIndex(
+            [os.path.normcase(os.path.join(root_folder, 'folderA', 'tracked.txt'))])
+
+        # Mock config to not exclude any file
+        config = mock_p4clean_config.return_value
+        config.is_excluded.return_value = False
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce = perforce
+
+        # the tested function call
+        result = instance.clean(root_folder)
+
+        folder_list = [path for path, directories, files in os.walk(root_folder)]
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(result, (2, [], 3, []))
+        self.assertEqual(sorted(folder_list),
+                         [root_folder, os.path.join(root_folder, 'folderA')])
+
+    @patch('p4clean.shell_marshal')
+    @patch('p4clean.P4CleanConfig')
+    def test_clean_reconcile(self, mock_p4clean_config, mock_shell_marshal):
+        """ Test P4Clean `clean` deletes the files Perforce would add, as
+        listed by `p4 reconcile -n -a`, and the folders they leave empty. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/folderA')
+        os.mkdir(root_folder + '/folderA/folderAA')
+        self._create_file(root_folder, 'folderA/tracked.txt')
+        self._create_file(root_folder, 'folderA/ignored.txt')
+        self._create_file(root_folder, 'folderA/folderAA/untracked.txt')
+
+        def marshal(command, timeout=None):
+            if command[2] == 'info':
+                return [{'code': 'stat', 'clientName': 'Client', 'clientRoot': root_folder,
+                         'serverVersion': 'P4D/LINUX26X86_64/2013.1/610569 (2013/03/19)'}]
+            if command[2] == 'reconcile':
+                return [{'code': 'stat', 'action': 'add', 'clientFile':
+                         os.path.join(root_folder, 'folderA', 'folderAA', 'untracked.txt')}]
+            # Synced files check
+            return [{'code': 'stat', 'clientFile':
+                     os.path.join(root_folder, 'folderA', 'tracked.txt')}]
+        mock_shell_marshal.side_effect = marshal
+
+        config = mock_p4clean_config.return_value
+        config.is_excluded.return_value = False
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce.use_reconcile = True
+        self.assertTrue(instance.perforce.can_reconcile())
+
+        result = instance.clean(root_folder)
+
+        folder_list = [path for path, directories, files in os.walk(root_folder)]
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(result, (1, [], 1, []))
+        self.assertEqual(sorted(folder_list),
+                         [root_folder, os.path.join(root_folder, 'folderA')])
+        self.assertEqual(len([call for call in mock_shell_marshal.call_args_list
+                              if call[0][0][2] == 'fstat']), 1)
+
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_clean_newer_than(self, mock_p4clean_config, mock_perforce):
+        """ Test P4Clean `clean` with `newer_than` only deletes the files
+        changed since and only queries Perforce about their folders. """
+        root_folder = tempfile.mkdtemp()
+        os.makedirs(root_folder + '/old/empty')
+        os.mkdir(root_folder + '/changed')
+        self._create_file(root_folder, 'old/untracked.txt')
+        self._create_file(root_folder, 'changed/tracked.txt')
+        self._create_file(root_folder, 'changed/old_untracked.txt')
+        old_time = time.time() - 1000
+        for path in ('old/untracked.txt', 'old/empty', 'old',
+                     'changed/tracked.txt', 'changed/old_untracked.txt'):
+            os.utime(os.path.join(root_folder, path), (old_time, old_time))
+        newer_than = time.time() - 100
+        self._create_file(root_folder, 'changed/new_tracked.txt')
+        self._create_file(root_folder, 'changed/new_untracked.txt')
+        os.makedirs(root_folder + '/build/sub')
+        self._create_file(root_folder, 'build/sub/output.o')
+
+        perforce = mock_perforce.return_value
+        perforce.has_synced_files.return_value = True
+        perforce.get_folders_tracked_files.return_value = TrackedIndex(
+            [os.path.normcase(os.path.join(root_folder, 'changed', 'new_tracked.txt'))])
+
+        config = mock_p4clean_config.return_value
+        config.is_excluded.return_value = False
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce = perforce
+        instance.newer_than = p4clean.parse_newer_than(str(newer_than))
+
+        result = instance.clean(root_folder)
+
+        entries = sorted([os.path.relpath(os.path.join(path, name), root_folder)
+                          for path, directories, files in os.walk(root_folder)
+                          for name in directories + files])
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(result, (2, [], 2, []))
+        self.assertEqual(entries, ['changed', 'changed/new_tracked.txt',
+                                   'changed/old_untracked.txt', 'changed/tracked.txt',
+                                   'old', 'old/empty', 'old/untracked.txt'])
+        perforce.get_folders_tracked_files.assert_called_once_with(
+            [os.path.join(root_folder, 'build', 'sub'), os.path.join(root_folder, 'changed')])
+
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_clean_roots(self, mock_p4clean_config, mock_perforce):
+        """ Test P4Clean `clean_roots` cleans several folders with a single
+        Perforce query and deletes no file in a folder with no synced file. """
+        root_folder = tempfile.mkdtemp()
+        os.makedirs(root_folder + '/folderA/folderAA')
+        os.makedirs(root_folder + '/folderB/folderBB')
+        self._create_file(root_folder, 'folderA/tracked.txt')
+        self._create_file(root_folder, 'folderA/folderAA/untracked.txt')
+        self._create_file(root_folder, 'folderB/untracked.txt')
+        roots = [os.path.join(root_folder, 'folderA'), os.path.join(root_folder, 'folderB')]
+
+        perforce = mock_perforce.return_value
+        perforce.use_cache = False
+        perforce.use_reconcile = False
+        perforce.get_roots_tracked_files.return_value = (
+            TrackedIndex([os.path.normcase(os.path.join(root_folder, 'folderA', 'tracked.txt'))]),
+            set([roots[0]]))
+
+        config = mock_p4clean_config.return_value
+        config.is_excluded.return_value = False
+
+        instance = P4Clean()
+        instance.perforce = perforce
+
+        result = instance.clean_roots(roots)
+
+        entries = sorted([os.path.relpath(os.path.join(path, name), root_folder)
+                          for path, directories, files in os.walk(root_folder)
+                          for name in directories + files])
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(result, (1, [], 2, []))
+        self.assertEqual(entries, ['folderA', 'folderA/tracked.txt',
+                                   'folderB', 'folderB/untracked.txt'])
+        perforce.get_roots_tracked_files.assert_called_once_with(roots)
+        self.assertEqual(p4clean.remove_nested_paths(['/a/b/c', '/a/b-c', '/a/b', '/a/b/']),
+                         ['/a/b', '/a/b-c'])
+
+    @patch('p4clean.stats', new_callable=Stats)
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_clean_stats(self, mock_p4clean_config, mock_perforce, mock_stats):
+        """ Test P4Clean `clean` method times its phases and counts its
+        system calls. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/folderA')
+        self._create_file(root_folder, 'folderA/untracked.txt')
+        self._create_file(root_folder, 'tracked.txt')
+
+        perforce = mock_perforce.return_value
+        perforce.get_tracked_files.return_value = TrackedIndex(
+            [os.path.normcase(os.path.join(root_folder, 'tracked.txt'))])
+        config = mock_p4clean_config.return_value
+        config.is_excluded.return_value = False
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce = perforce
+        instance.clean(root_folder)
+        stats_path = os.path.join(root_folder, 'stats.json')
+        saved = mock_stats.save(stats_path)
+        stats_file = open(stats_path)
+        values = json.load(stats_file)
+        stats_file.close()
+        shutil.rmtree(root_folder)
+
+        self.assertTrue(saved)
+        self.assertEqual([phase['name'] for phase in values['phases']],
+                         ['walk', 'diff', 'unlink', 'rmdir'])
+        self.assertEqual(values['counters']['listdir'], 2)
+        self.assertEqual(values['counters']['unlink'], 1)
+        self.assertEqual(values['counters']['rmdir'], 1)
+        self.assertTrue(values['counters']['syscalls'] >= 4)
+        self.assertTrue('rmdir' in mock_stats.format())
+
+    def test_clean_shards(self):
+        """ Test P4Clean `clean` method cleans each top level folder in a
+        worker process, then the files of root. """
+        # Patched Perforce methods are only inherited by forked processes.
+        if platform.system() == 'Windows':
+            return
+
+        root_folder = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(root_folder + '/folderA')
+        os.mkdir(root_folder + '/folderB')
+        os.mkdir(root_folder + '/folderB/folderBB')
+        os.mkdir(root_folder + '/folderC')
+        self._create_file(root_folder, 'tracked.txt')
+        self._create_file(root_folder, 'untracked.txt')
+        self._create_file(root_folder, 'folderA/tracked.txt')
+        self._create_file(root_folder, 'folderA/untracked.txt')
+        self._create_file(root_folder, 'folderB/folderBB/untracked.txt')
+        tracked_files = [os.path.join(root_folder, 'tracked.txt'),
+                         os.path.join(root_folder, 'folderA', 'tracked.txt')]
+
+        def fstat(perforce, root, option, fields, recursive=True):
+            for tracked_file in tracked_files:
+                folder = os.path.dirname(tracked_file)
+                if folder == root or (recursive and tracked_file.startswith(root + os.sep)):
+                    yield {'code': 'stat', 'clientFile': tracked_file}
+
+        with patch.object(Perforce, 'info') as info_mock:
+            info_mock.return_value = (2010, root_folder, 'client')
+            with patch.object(Perforce, '_get_perforce_fstat', new=fstat):
+                with patch.object(Perforce, 'has_synced_files', new=lambda perforce, root: True):
+                    instance = P4Clean()
+                    instance.config = P4CleanConfig(root_folder)
+                    instance.processes = 2
+                    result = instance.clean(root_folder)
+
+        folder_list = [path for path, directories, files in os.walk(root_folder)]
+        file_list = [os.path.join(path, file) for path, directories, files in os.walk(root_folder)
+                     for file in files]
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(result, (3, [], 3, []))
+        self.assertEqual(sorted(folder_list), [root_folder, os.path.join(root_folder, 'folderA')])
+        self.assertEqual(sorted(file_list), sorted(tracked_files))
+
+    def test_remove_files_and_folders(self):
+        """ Test `remove_files` and `FolderRemover` delete files and folders
+        by folder and do not follow a folder replaced by a link. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/folderA')
+        os.mkdir(root_folder + '/folderA/folderAA')
+        os.mkdir(root_folder + '/folderA/folderAB')
+        os.mkdir(root_folder + '/folderB')
+        self._create_file(root_folder, 'folderA/a.txt')
+        self._create_file(root_folder, 'folderA/b.txt')
+        self._create_file(root_folder, 'folderB/c.txt')
+        filenames = [os.path.join(root_folder, path)
+                     for path in ['folderA/a.txt', 'folderA/b.txt', 'folderA/missing.txt',
+                                  'folderB/c.txt']]
+
+        errors = remove_files(filenames, jobs=2)
+
+        self.assertEqual([error is None for error in errors], [True, True, False, True])
+        self.assertTrue(filenames[2] in str(errors[2]))
+        self.assertEqual(os.listdir(root_folder + '/folderB'), [])
+
+        folder_remover = FolderRemover()
+        for path in ['folderA/folderAB', 'folderA/folderAA', 'folderA', 'folderB']:
+            folder_remover.release(os.path.join(root_folder, path))
+            self.assertEqual(folder_remover.remove(os.path.join(root_folder, path)), None)
+        folder_remover.close()
+        self.assertEqual(os.listdir(root_folder), [])
+        self.assertEqual(folder_remover.folder_fds, {})
+
+        # A folder replaced by a link to another folder
+        if hasattr(os, 'symlink'):
+            os.mkdir(root_folder + '/folderC')
+            self._create_file(root_folder, 'folderC/d.txt')
+            os.symlink(root_folder + '/folderC', root_folder + '/link')
+            errors = remove_files([os.path.join(root_folder, 'link', 'd.txt')], jobs=2)
+            if p4clean._unlinkat:
+                self.assertNotEqual(errors, [None])
+                self.assertEqual(os.listdir(root_folder + '/folderC'), ['d.txt'])
+
+        shutil.rmtree(root_folder)
+
+    def test_watcher(self):
+        """ Test `Watcher` keeps up with folder changes and asks Perforce for
+        the have list again only after a sync. """
+        if not p4clean._libc:
+            return
+        root_folder = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(root_folder + '/folderA')
+        self._create_file(root_folder, 'folderA/tracked.txt')
+        self._create_file(root_folder, 'folderA/untracked.txt')
+
+        perforce = Mock()
+        perforce._get_have_cache_key.return_value = ('client', 42, 1)
+        perforce._get_depot_files.side_effect = lambda root, option: TrackedIndex(
+            option == '-Rh' and [os.path.join(root_folder, 'folderA', 'tracked.txt')] or [])
+        config = Mock()
+        instance = P4Clean(perforce)
+        instance.config = config
+        socket_path = os.path.join(root_folder, 'watch.sock')
+        config.is_excluded.side_effect = lambda path: path == socket_path
+        watcher = Watcher(instance, root_folder, socket_path, interval=0)
+        task = BackgroundTask(watcher.serve)
+
+        def query():
+            for retry in range(100):
+                try:
+                    return [(entry.path, entry.is_dir) for entry in query_watcher(root_folder, socket_path)]
+                except socket.error:
+                    # Not started yet
+                    time.sleep(0.05)
+                    if not task.is_alive():
+                        task.result()
+
+        try:
+            self.assertEqual(query(), [(os.path.join(root_folder, 'folderA', 'untracked.txt'), False)])
+
+            # New files and folders
+            os.makedirs(root_folder + '/folderB/folderBB')
+            self._create_file(root_folder, 'folderB/folderBB/new.txt')
+            os.remove(root_folder + '/folderA/untracked.txt')
+            self.assertEqual(query(), [
+                (os.path.join(root_folder, 'folderB', 'folderBB', 'new.txt'), False),
+                (os.path.join(root_folder, 'folderB', 'folderBB'), True),
+                (os.path.join(root_folder, 'folderB'), True)])
+
+            # Deleted and renamed folders
+            os.rename(root_folder + '/folderB', root_folder + '/folderC')
+            shutil.rmtree(root_folder + '/folderC/folderBB')
+            self.assertEqual(query(), [(os.path.join(root_folder, 'folderC'), True)])
+        finally:
+            watcher.stop()
+            task.result()
+        shutil.rmtree(root_folder)
+
+        # Not synced since: the have list was queried once.
+        self.assertTrue(perforce._get_have_cache_key.call_count > 1)
+        self.assertEqual([call[0][1] for call in perforce._get_depot_files.call_args_list].count('-Rh'), 1)
+
+    def test_watcher_socket(self):
+        """ Test the watch service does not replace the socket of a running
+        service and the query trusts no socket other users can bind. """
+        root_folder = os.path.realpath(tempfile.mkdtemp())
+        socket_path = os.path.join(root_folder, 'watch.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+        try:
+            watcher = Watcher(P4Clean(Mock()), root_folder, socket_path, interval=0)
+            with self.assertRaises(OSError):
+                watcher.serve()
+            self.assertTrue(os.path.exists(socket_path))
+
+            os.chmod(root_folder, 0755)
+            with self.assertRaises(socket.error):
+                query_watcher(root_folder, socket_path)
+        finally:
+            server.close()
+            shutil.rmtree(root_folder)
+
+    @patch('p4clean.logger')
+    def test_query_without_unix_sockets(self, mock_logger):
+        """ Test P4Clean `query` and `watch` log an error where unix sockets
+        are not available (e.g.: on Windows). """
+        instance = P4Clean(Mock())
+        with patch.object(p4clean, 'socket', Mock(spec=['error'], error=socket.error)):
+            instance.query('/path')
+            instance.watch('/path')
+
+        self.assertEqual([call[0][0] for call in mock_logger.error.call_args_list], [
+            "Cannot query '/path' (the watch service is only available on Linux)",
+            "Cannot watch '/path' (the watch service is only available on Linux)"])
+
+    @patch('p4clean.logger')
+    def test_run_paths_not_folders(self, mock_logger):
+        """ Test P4Clean `run` cleans nothing if a PATH argument is not a
+        folder. """
+        root_folder = tempfile.mkdtemp()
+        self._create_file(root_folder, 'file.txt')
+        perforce = Mock()
+        perforce.is_inside_workspace.return_value = True
+        instance = P4Clean(perforce)
+        instance.clean = Mock()
+        instance.clean_roots = Mock()
+
+        for paths in ([root_folder + '/nope', root_folder], [root_folder + '/file.txt']):
+            mock_logger.reset_mock()
+            with patch('sys.argv', ['p4clean'] + paths):
+                instance.run()
+            self.assertEqual([call[0][0] for call in mock_logger.error.call_args_list],
+                             ["Nothing to clean: '%s' is not a folder." % paths[0]])
+        shutil.rmtree(root_folder)
+
+        self.assertFalse(instance.clean.called)
+        self.assertFalse(instance.clean_roots.called)
+
+    def test_iter_untracked(self):
+        """ Test `iter_untracked` yields what a clean would delete without
+        deleting it and `delete_untracked` deletes it. """
+        root_folder = os.path.realpath(tempfile.mkdtemp())
+        os.mkdir(root_folder + '/folderA')
+        os.mkdir(root_folder + '/folderB')
+        os.mkdir(root_folder + '/folderB/folderBB')
+        self._create_file(root_folder, 'folderA/tracked.txt')
+        self._create_file(root_folder, 'folderA/untracked.txt')
+        self._create_file(root_folder, 'folderA/untracked.keep')
+        self._create_file(root_folder, 'folderB/folderBB/untracked.txt')
+
+        perforce = Mock()
+        perforce.root = root_folder
+        perforce.is_inside_workspace.return_value = True
+        perforce.get_tracked_files.return_value = TrackedIndex(
+            [os.path.normcase(os.path.join(root_folder, 'folderA', 'tracked.txt'))])
+
+        entries = list(iter_untracked(root_folder, ['*.keep'], perforce=perforce))
+
+        self.assertEqual([(entry.path, entry.reason, entry.is_dir) for entry in entries], [
+            (os.path.normcase(os.path.join(root_folder, 'folderB', 'folderBB', 'untracked.txt')),
+             UntrackedEntry.UNTRACKED_FILE, False),
+            (os.path.join(root_folder, 'folderB', 'folderBB'), UntrackedEntry.UNTRACKED_TREE, True),
+            (os.path.join(root_folder, 'folderB'), UntrackedEntry.UNTRACKED_TREE, True),
+            (os.path.normcase(os.path.join(root_folder, 'folderA', 'untracked.txt')),
+             UntrackedEntry.UNTRACKED_FILE, False)])
+        self.assertEqual(entries[0].size, 0)
+        self.assertFalse(entries[0].is_link)
+        self.assertTrue(os.path.exists(entries[0].path))
+
+        self.assertEqual(delete_untracked(entries, jobs=2), [])
+        folder_list = [path for path, directories, files in os.walk(root_folder)]
+        self.assertEqual(sorted(folder_list), [root_folder, os.path.join(root_folder, 'folderA')])
+        self.assertEqual(sorted(os.listdir(os.path.join(root_folder, 'folderA'))),
+                         ['tracked.txt', 'untracked.keep'])
+        shutil.rmtree(root_folder)
+
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_iter_untracked_matches_clean(self, mock_p4clean_config, mock_perforce):
+        """ Test P4Clean `iter_untracked` yields exactly what `clean`
+        deletes. """
+        root_folder = os.path.realpath(tempfile.mkdtemp())
+        for folder in ['build', 'build/obj', 'src', 'src/empty', 'src/empty/deeper',
+                       'cache', 'logs', 'logs/old']:
+            os.mkdir(os.path.join(root_folder, folder))
+        self._create_file(root_folder, 'build/obj/b.o')
+        self._create_file(root_folder, 'src/tracked.c')
+        self._create_file(root_folder, 'src/untracked.c')
+        self._create_file(root_folder, 'logs/old/run.log')
+        self._create_file(root_folder, 'logs/old/run.tmp')
+
+        perforce = mock_perforce.return_value
+        perforce.get_tracked_files.return_value = TrackedIndex(
+            [os.path.join(root_folder, 'src', 'tracked.c')])
+        # Mock config to exclude log files and the cache folder
+        config = mock_p4clean_config.return_value
+        config.is_excluded.side_effect = lambda path: path.endswith('.log') or \
+            path == os.path.join(root_folder, 'cache')
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce = perforce
+
+        entries = [entry.path for entry in instance.iter_untracked(root_folder)]
+        before = set()
+        for path, directories, files in os.walk(root_folder):
+            before.update([os.path.join(path, name) for name in directories + files])
+        instance.clean(root_folder)
+        after = set()
+        for path, directories, files in os.walk(root_folder):
+            after.update([os.path.join(path, name) for name in directories + files])
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(len(entries), len(set(entries)))
+        self.assertEqual(set(entries), before - after)
+        self.assertEqual(sorted(after), [os.path.join(root_folder, name) for name in
+                                         ['cache', 'logs', 'logs/old', 'logs/old/run.log',
+                                          'src', 'src/tracked.c']])
+
+    @patch('p4clean.logger')
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_clean_untracked_tree(self, mock_p4clean_config, mock_perforce, mock_logger):
+        """ Test P4Clean `clean` method deletes a folder without tracked nor
+        excluded files as a single unit. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/build')
+        os.mkdir(root_folder + '/build/obj')
+        os.mkdir(root_folder + '/logs')
+        self._create_file(root_folder, 'tracked.txt')
+        self._create_file(root_folder, 'build/a.o')
+        self._create_file(root_folder, 'build/obj/b.o')
+        self._create_file(root_folder, 'logs/run.log')
+        self._create_file(root_folder, 'logs/run.tmp')
+
+        perforce = mock_perforce.return_value
+        perforce.get_tracked_files.return_value = TrackedIndex(
+            [os.path.normcase(os.path.join(root_folder, 'tracked.txt'))])
+        # Mock config to exclude log files
+        config = mock_p4clean_config.return_value
+        config.is_excluded.side_effect = lambda path: path.endswith('.log')
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce = perforce
+
+        # the tested function call
+        result = instance.clean(root_folder)
+
+        remaining = sorted(os.listdir(root_folder))
+        shutil.rmtree(root_folder)
+        messages = [call[0][0] for call in mock_logger.info.call_args_list]
+
+        self.assertEqual(result, (3, [], 2, []))
+        self.assertEqual(remaining, ['logs', 'tracked.txt'])
+        self.assertEqual(messages, [
+            "Deleted file: '%s'" % os.path.join(root_folder, 'logs', 'run.tmp'),
+            "Deleted folder tree: '%s' " % os.path.join(root_folder, 'build')])
+
+    @patch('p4clean.Perforce')
+    def test_clean_excluded_folder(self, mock_perforce):
+        """ Test P4Clean `clean` method leaves the whole tree of an excluded
+        folder untouched. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/keep')
+        os.mkdir(root_folder + '/keep/sub')
+        os.mkdir(root_folder + '/keep/empty')
+        self._create_file(root_folder, 'keep/sub/untracked.txt')
+        self._create_file(root_folder, 'untracked.txt')
+
+        perforce = mock_perforce.return_value
+        perforce.get_tracked_files.return_value = TrackedIndex(
+            [os.path.normcase(os.path.join(root_folder, 'tracked.txt'))])
+
+        instance = P4Clean()
+        instance.config = P4CleanConfig(root_folder, os.path.join(root_folder, 'keep'))
+        instance.perforce = perforce
+
+        # the tested function call
+        result = instance.clean(root_folder)
+
+        folder_list = [path for path, directories, files in os.walk(root_folder)]
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(result, (1, [], 0, []))
+        self.assertEqual(len(folder_list), 4)
+
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_clean_incremental(self, mock_p4clean_config, mock_perforce):
+        """ Test P4Clean `clean` method does not list again the folders left
+        unchanged since the last incremental clean. """
+        root_folder = tempfile.mkdtemp()
+        os.mkdir(root_folder + '/folderA')
+        self._create_file(root_folder, 'folderA/tracked.txt')
+        # Folder last changed long before the snapshot
+        os.utime(root_folder + '/folderA', (0, 0))
+
+        perforce = mock_perforce.return_value
+        perforce.get_tracked_files.return_value = TrackedIndex(
+            [os.path.normcase(os.path.join(root_folder, 'folderA', 'tracked.txt'))])
+        # Mock config to only exclude the snapshot file
+        config = mock_p4clean_config.return_value
+        config.is_excluded.side_effect = lambda path: path.endswith(SNAPSHOT_FILENAME)
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce = perforce
+        instance.incremental = True
+
+        instance.clean(root_folder)
+        snapshot = instance._load_snapshot(root_folder)
+        self.assertEqual(snapshot[os.path.join(root_folder, 'folderA')],
+                         (0, [], ['tracked.txt']))
+
+        # Unchanged folder is not listed again: an untracked file sneaked in
+        # without touching the folder modification time is not seen.
+        self._create_file(root_folder, 'folderA/untracked.txt')
+        os.utime(root_folder + '/folderA', (0, 0))
+        self.assertEqual(instance.clean(root_folder), (0, [], 0, []))
+
+        # Changed folder is listed again.
+        os.utime(root_folder + '/folderA', None)
+        self.assertEqual(instance.clean(root_folder), (1, [], 0, []))
+
+        shutil.rmtree(root_folder)
+
+    @patch('p4clean.Perforce')
+    @patch('p4clean.P4CleanConfig')
+    def test_delete_untracked_files_in_parallel(self, mock_p4clean_config, mock_perforce):
+        """ Test P4Clean `delete_untracked_files` method deletes files with a
+        pool of threads and reports errors in a stable order. """
+        root_folder = tempfile.mkdtemp()
+
+        filenames = [os.path.join(root_folder, 'temp%02d.txt' % i) for i in range(20)]
+        for filename in filenames:
+            self._create_file(root_folder, os.path.basename(filename))
+        missing_filenames = [os.path.join(root_folder, 'missing%d.txt' % i) for i in range(3)]
+
+        perforce = mock_perforce.return_value
+        perforce.get_untracked_files.return_value = filenames + missing_filenames
+        config = mock_p4clean_config.return_value
+        config.is_excluded.return_value = False
+
+        instance = P4Clean()
+        instance.config = config
+        instance.perforce = perforce
+        instance.jobs = 4
+
+        # the tested function call
+        count, msgs = instance.delete_untracked_files()
+
+        remaining = os.listdir(root_folder)
+        shutil.rmtree(root_folder)
+
+        self.assertEqual(count, 20)
+        self.assertEqual(remaining, [])
+        self.assertEqual(len(msgs), 3)
+        for msg, filename in zip(msgs, missing_filenames):
+            self.assertTrue(filename in msg)
+
     @patch('p4clean.Perforce')
     def test_delete_empty_folders_error_count(self, mock_perforce):
         """ Test P4Clean method `delete_empty_folders` returns the correct
@@ -232,8 +1272,9 @@ class P4CleanTests(unittest2.TestCase):
             mock_config = mock_p4clean_config.return_value
             mock_config.is_excluded.return_value = False
 
-            with patch('os.rmdir') as mock_rmdir:
-                # mock rmdir to raise exception
+            # Folders deleted by path (not relative to their parent) and
+            # mock rmdir to raise exception
+            with patch('p4clean._unlinkat', None), patch('os.rmdir') as mock_rmdir:
                 mock_rmdir.side_effect = Exception('Boom')
 
                 instance = P4Clean()